@@ -18,6 +18,8 @@
 
 import os
 import sys
+import errno
+import fcntl
 import socket
 import select
 import time
@@ -43,7 +45,7 @@ def sourceFinder(directory):
 
   return sourceFinder(directory)
 
-directory = sourceFinder(os.path.dirname(sys.argv[0]))
+directory = sourceFinder(os.path.dirname(os.path.abspath(__file__)))
 if directory == None:
   print("Unable to find common python directory")
   sys.exit(1)
@@ -56,100 +58,278 @@ except:
   print("Unable to find Helper.py")
   sys.exit(1)
 
+# every frame and line proxied: --trace
+trace = traceLogger('EnsimeClient', 'proxy')
+
 DEFAULT_LOG_FILENAME = 'EnsimeClient.log'
+LOG_LEVELS = ['debug', 'info', 'warning', 'error']
+READ_BUFFER_SIZE = 256 * 1024
+DRAIN_TIMEOUT = 5 # seconds to wait for a descriptor to be writable when exiting
+
+# would the operation have blocked on a non-blocking descriptor?
+def wouldBlock(e):
+  return e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+# replies to calls are written without delay, see Proxy.Write.stdout
+def isReply(data):
+  return data.startswith('(:return')
+
+def setNonBlocking(fd, flags):
+  fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
 
 class Proxy:
-  """Base class providing basic proxy features: read and write"""
+  """Base class providing basic proxy features: read and write
+
+  Descriptors are non-blocking: reads return what is available now, writes
+  are buffered per direction and flushed when the descriptor is writable."""
 
   class Read:
     def __init__(self, serverSocket):
       self.serverSocket = serverSocket
-      self.buf = bytearray(4096)
-
+      self.stdinFd = sys.stdin.fileno()
+      self.buf = bytearray(READ_BUFFER_SIZE)
+      self.view = memoryview(self.buf)
+      self.hexSize = ''     # header of the frame being read
+      self.size = None      # size of the frame being read, once its header is complete
+      self.left = 0         # characters left to read in the frame
+      self.missing = 0      # continuation bytes left to read for the last character
+      self.pieces = []      # frame data read so far
+      self.stdinRest = ''   # incomplete stdin line
+      self.closed = False   # the server connection is closed, failed or sent invalid data
+
+    # read all the data available from the server (large reads into a reusable buffer)
+    # return the list of frames completed: [(size, hexSize, data)]
+    # closed is set once the connection is closed or failed: frames completed
+    # before are still returned
     def server(self):
-
-      def readUntil(size):
-        data = ''
-        while size > 0:
-          s = 4096
-          if size <= s: s = size
-
-          s = self.serverSocket.recv_into(self.buf, s)
-          decoded = self.buf[:s].decode("utf-8")
-          data += decoded
-          size -= len(decoded)
-        return data
-
-      # note: the size given in Swank header correspond to the length of the string which follow,
-      # which may differ from the real number of bytes (depending on encoding. e.g. utf-8)
-      # take care to a) decode() b) calculate using len(decoded)
-      try:
-        hexSize = self.serverSocket.recv(6)
-        size = int(hexSize, 16)
-        data = readUntil(size)
-      except Exception as e:
-        log.exception("Proxy.Read.server: unable to read data from server: " + str(e))
-        return (None, None, None)
-      return (size, hexSize, data)
-
+      frames = []
+
+      while True:
+        try:
+          s = self.serverSocket.recv_into(self.buf)
+        except socket.error as e:
+          if wouldBlock(e): break
+          log.error("Proxy.Read.server: unable to read data from server: " + str(e))
+          self.closed = True
+          break
+
+        if s == 0:
+          log.error("Proxy.Read.server: connection closed by server")
+          self.closed = True
+          break
+
+        frames.extend(self.frames(self.view[:s].tobytes()))
+        if self.closed:
+          break
+
+        # buffer not filled: nothing left to read for now
+        if s < len(self.buf): break
+
+      return frames
+
+    # note: the size given in Swank header correspond to the length of the string which follow,
+    # which may differ from the real number of bytes (depending on encoding. e.g. utf-8)
+    # data is kept utf-8 encoded, characters are counted with utf8Advance
+    # on an invalid header, closed is set and the frames completed before are returned
+    def frames(self, data):
+      frames = []
+      pos = 0
+      end = len(data)
+
+      while pos < end:
+
+        if self.size == None:
+          need = 6 - len(self.hexSize)
+          self.hexSize += data[pos:pos+need]
+          pos += need
+          if len(self.hexSize) < 6: break
+
+          try:
+            self.size = self.left = int(self.hexSize, 16)
+          except ValueError:
+            log.error("Proxy.Read.frames: invalid header: '%s'" % self.hexSize)
+            self.closed = True
+            break
+
+        if self.missing > 0:
+          nextPos = min(pos + self.missing, end)
+          self.missing -= nextPos - pos
+        else:
+          (nextPos, chars) = utf8Advance(data, pos, self.left, end)
+          self.left -= chars
+
+        self.pieces.append(data[pos:nextPos])
+        pos = nextPos
+
+        if self.left == 0 and self.missing == 0:
+          frame = ''.join(self.pieces)
+
+          # the last character may be split: wait for its continuation bytes
+          self.missing = utf8Missing(frame)
+          if self.missing > 0:
+            self.pieces = [frame]
+            continue
+
+          frames.append((self.size, self.hexSize, frame))
+          self.hexSize = ''
+          self.size = None
+          self.pieces = []
+
+      return frames
+
+    # return the list of complete lines available, or None at end of input
     def stdin(self):
       try:
-        data = sys.stdin.readline()
-      except Exception as e:
+        data = os.read(self.stdinFd, 4096)
+      except OSError as e:
+        if wouldBlock(e): return []
         log.error("Proxy.Read.stdin: unable to read data from stdin: " + str(e))
         return None
-      return data
+
+      if data == '':
+        return None
+
+      lines = (self.stdinRest + data).split("\n")
+      self.stdinRest = lines.pop()
+      return [line + "\n" for line in lines]
 
   class Write:
     def __init__(self, serverSocket):
       self.serverSocket = serverSocket
+      self.stdoutFd = sys.stdout.fileno()
+      self.toServer = []    # data waiting for the server socket to be writable
+      self.toStdout = []    # data waiting to be written to stdout
+      self.maxLatency = 0   # seconds non urgent stdout data may be held to batch writes
+      self.stdoutDeadline = None  # time when pending stdout data must be written
 
     def server(self, data):
-      try:
-        self.serverSocket.sendall(data)
-      except Exception as e:
-        log.error("Proxy.Write.server: unable to send data to server: " + str(e))
-        return False
+      self.toServer.append(data)
+      return self.flushServer()
+
+    # stdout data is only buffered: all data buffered during a loop iteration is
+    # written at once (see runProxy). Non urgent data may be held up to maxLatency.
+    def stdout(self, data, urgent = True):
+      self.toStdout.append(data)
+
+      deadline = time.time()
+      if not urgent: deadline += self.maxLatency
+
+      if self.stdoutDeadline == None or deadline < self.stdoutDeadline:
+        self.stdoutDeadline = deadline
       return True
 
-    def stdout(self, data):
-      try:
-        sys.stdout.write(data)
-        sys.stdout.flush()
-      except Exception as e:
-        log.error("Proxy.Write.stdout: unable to write data to stdout: " + str(e))
-        return False
+    # seconds until pending stdout data must be written, None if nothing is pending
+    def stdoutTimeout(self):
+      if self.stdoutDeadline == None: return None
+      return max(0, self.stdoutDeadline - time.time())
+
+    def hasServerData(self):
+      return len(self.toServer) > 0
+
+    def flushServer(self):
+      def write(data):
+        try:
+          return self.serverSocket.send(data)
+        except socket.error as e:
+          if wouldBlock(e): return 0
+          log.error("Proxy.Write.server: unable to send data to server: " + str(e))
+          return None
+      return self.flush(self.toServer, write)
+
+    def flushStdout(self):
+      self.stdoutDeadline = None
+
+      def write(data):
+        try:
+          return os.write(self.stdoutFd, data)
+        except OSError as e:
+          if wouldBlock(e): return 0
+          log.error("Proxy.Write.stdout: unable to write data to stdout: " + str(e))
+          return None
+      return self.flush(self.toStdout, write)
+
+    # write as much pending data as possible, keep the rest
+    def flush(self, pending, write):
+      if len(pending) == 0: return True
+
+      data = ''.join(pending)
+      del pending[:]
+
+      s = write(data)
+      if s == None: return False
+      if s < len(data): pending.append(data[s:])
       return True
 
+    # something left to write once the descriptor is writable
+    def stdoutBlocked(self):
+      return len(self.toStdout) > 0 and self.stdoutDeadline == None
+
+    # write all pending data, waiting for the descriptors to be writable
+    # (when exiting: data held by maxLatency or partially written is not lost)
+    def drain(self):
+      self.stdoutDeadline = None
+      done = True
+
+      for (fd, pending, flush) in [(self.serverSocket, self.toServer, self.flushServer),
+                                   (self.stdoutFd, self.toStdout, self.flushStdout)]:
+        while len(pending) > 0:
+          try:
+            (i, o, e) = select.select([], [fd], [], DRAIN_TIMEOUT)
+          except select.error as e:
+            if e.args[0] == errno.EINTR: continue
+            o = []
+          if len(o) == 0 or not flush():
+            log.error("Proxy.Write.drain: unable to write pending data")
+            del pending[:]
+            done = False
+
+      return done
+
   def __init__(self, serverSocket):
     self.serverSocket = serverSocket
     self.read = self.Read(serverSocket)
     self.write = self.Write(serverSocket)
 
+  # server socket is readable: handle every frame completed
+  def fromServer(self):
+    for (size, hexSize, data) in self.read.server():
+      if not self.fromServerFrame(size, hexSize, data):
+        return False
+
+    return not self.read.closed
+
+  # stdin is readable: handle every line completed
+  def fromStdin(self):
+    lines = self.read.stdin()
+    if lines == None:
+      return False
+
+    for data in lines:
+      if not self.fromStdinLine(data):
+        return False
+
+    return True
+
+  def fromServerFrame(self, size, hexSize, data): return True
+  def fromStdinLine(self, data): return True
+
 class RawProxy(Proxy):
   """Raw Proxy: direct data proxying"""
 
   def __init__(self, serverSocket):
     Proxy.__init__(self, serverSocket)
 
-  def fromServer(self):
-    (size, hexSize, data) = self.read.server()
-    if size == None:
-      return False
-
-    log.debug("%s server: %s%s", self.__class__.__name__, hexSize, data)
+  def fromServerFrame(self, size, hexSize, data):
+    trace.debug("%s server: %s%s", self.__class__.__name__, hexSize, data)
 
-    if not self.write.stdout(hexSize + data + "\n"):
+    if not self.write.stdout(hexSize + data + "\n", isReply(data)):
       return False
 
     return True
 
-  def fromStdin(self):
-    data = self.read.stdin()
-    if data == None:
-      return False
-
-    log.debug("%s stdin: %s", self.__class__.__name__, data.strip())
+  def fromStdinLine(self, data):
+    if trace.isEnabledFor(logging.DEBUG):
+      trace.debug("%s stdin: %s", self.__class__.__name__, data.strip())
 
     if not self.write.server(data):
       return False
@@ -157,22 +337,23 @@ class RawProxy(Proxy):
     return True
 
 class AsciiRawProxy(RawProxy):
-  """Ascii Raw Proxy: replace utf-8 characters with ascii"""
+  """Ascii Raw Proxy: replace utf-8 characters with ascii (xml character references)
+
+  Not needed for utf-8 support: RawProxy forwards utf-8 frames untouched."""
 
   def __init__(self, serverSocket):
     RawProxy.__init__(self, serverSocket)
 
-  def fromServer(self):
-    (size, hexSize, udata) = self.read.server()
-    if size == None:
-      return False
+  def fromServerFrame(self, size, hexSize, udata):
+    if not reNonAscii.search(udata):
+      data = udata
+    else:
+      data = udata.decode('utf-8').encode('ascii', 'xmlcharrefreplace')
+      hexSize = "%06x" % (len(data))
 
-    data = udata.encode('ascii', 'xmlcharrefreplace')
-    hexSize = "%06x" % (len(data))
+    trace.debug("%s server: %s%s", self.__class__.__name__, hexSize, data)
 
-    log.debug("%s server: %s%s", self.__class__.__name__, hexSize, data)
-
-    if not self.write.stdout(hexSize + data + "\n"):
+    if not self.write.stdout(hexSize + data + "\n", isReply(data)):
       return False
 
     return True
@@ -183,26 +364,19 @@ class SwankProxy(Proxy):
   def __init__(self, serverSocket):
     Proxy.__init__(self, serverSocket)
 
-  def fromServer(self):
-    (size, hexSize, data) = self.read.server()
-    if size == None:
-      return False
+  def fromServerFrame(self, size, hexSize, data):
+    trace.debug("%s server: %s%s", self.__class__.__name__, hexSize, data)
 
-    log.debug("%s server: %s%s", self.__class__.__name__, hexSize, data)
-
-    if not self.write.stdout(data + "\n"):
+    if not self.write.stdout(data + "\n", isReply(data)):
       return False
 
     return True
 
-  def fromStdin(self):
-    data = self.read.stdin()
-    if data == None:
-      return False
-
-    log.debug("%s stdin: %s", self.__class__.__name__, data.strip())
+  def fromStdinLine(self, data):
+    if trace.isEnabledFor(logging.DEBUG):
+      trace.debug("%s stdin: %s", self.__class__.__name__, data.strip())
 
-    dataSize = "%06x" % (len(data))
+    dataSize = "%06x" % (utf8Length(data))
     if not self.write.server(dataSize + data):
       return False
 
@@ -213,7 +387,11 @@ def usage():
     '[-l|--log logfilename]',
     '[-f|--portfile port_filename]',
     '[-p|--port port_number]',
-    '[-r|--raw]'
+    '[-r|--raw]',
+    '[-R|--rawascii]',
+    '[-L|--max-latency milliseconds]',
+    '[--log-level debug|info|warning|error]',
+    '[-t|--trace]'
   ]
 
   print("Usage: %s %s" % (sys.argv[0], ' '.join(helplist)))
@@ -240,6 +418,21 @@ def main():
                     dest='rawascii',
                     action="store_true",
                     help='raw ascii mode')
+  parser.add_option('-L', '--max-latency',
+                    dest='maxLatency',
+                    type='int',
+                    default=0,
+                    help='milliseconds events may be held to batch writes to stdout (replies are never held)')
+  parser.add_option('--log-level',
+                    dest='logLevel',
+                    type='choice',
+                    choices=LOG_LEVELS,
+                    default='info',
+                    help='log level: ' + ', '.join(LOG_LEVELS) + ' (default: info)')
+  parser.add_option('-t', '--trace',
+                    dest='trace',
+                    action="store_true",
+                    help='log every proxied frame')
 
   (options, args) = parser.parse_args()
 
@@ -247,7 +440,9 @@ def main():
   if options.log != None:
     logfile = options.log
 
-  LogSetup().setup('EnsimeClient', logfile, False)
+  LogSetup().setup('EnsimeClient', logfile, False, getattr(logging, options.logLevel.upper()))
+  if options.trace:
+    LogSetup().setTrace('EnsimeClient', 'proxy')
 
   if options.port != None:
     try: port = int(options.port)
@@ -289,7 +484,7 @@ def main():
   else:
     proxy = SwankProxy(serverSocket)
 
-  runProxy(proxy)
+  runProxy(proxy, options.maxLatency / 1000.0)
 
   serverSocket.close()
 
@@ -297,7 +492,13 @@ def main():
 
   return 0
 
-def runProxy(proxy):
+# Event loop: wait for the server socket or stdin to be readable, or for the
+# server socket/stdout to be writable when data is waiting to be written.
+# All descriptors are non-blocking, so a partial frame never blocks the loop.
+# The only timeout is the deadline of stdout data held to batch writes.
+# note: select() is used rather than epoll/selectors: only 3 descriptors
+# are watched and selectors is not available with python 2.
+def runProxy(proxy, maxLatency = 0):
 
   def serverError():
     log.error("runProxy: serverError: server error")
@@ -307,29 +508,65 @@ def runProxy(proxy):
     log.error("runProxy: stdinError: stdin error")
     return False
 
-  flag = True
-  input = [proxy.serverSocket, sys.stdin]
-  output = []
-  error = [proxy.serverSocket, sys.stdin]
-  timeout = 0.1 # sec
+  serverSocket = proxy.serverSocket
+  proxy.write.maxLatency = maxLatency
+  stdinFd = sys.stdin.fileno()
+  stdoutFd = sys.stdout.fileno()
 
-  inputHandlers = {proxy.serverSocket: proxy.fromServer, sys.stdin: proxy.fromStdin}
-  errorHandlers = {proxy.serverSocket: serverError, sys.stdin: stdinError}
+  # read both before changing any: stdin and stdout may share their flags (tty)
+  stdinFlags = fcntl.fcntl(stdinFd, fcntl.F_GETFL)
+  stdoutFlags = fcntl.fcntl(stdoutFd, fcntl.F_GETFL)
 
-  while flag:
-    try:
-      (i, o, e) = select.select(input, output, error, timeout)
-    except BaseException as e:
-      log.error("Handling exception: " + str(e))
-      flag = False
-
-    for ii in i:
-      if not inputHandlers[ii]():
-        flag = False
-
-    for ee in e:
-      if not errorHandlers[ee]():
-        flag = False
+  serverSocket.setblocking(False)
+  setNonBlocking(stdinFd, stdinFlags)
+  setNonBlocking(stdoutFd, stdoutFlags)
+
+  inputHandlers = {serverSocket: proxy.fromServer, stdinFd: proxy.fromStdin}
+  outputHandlers = {serverSocket: proxy.write.flushServer, stdoutFd: proxy.write.flushStdout}
+  errorHandlers = {serverSocket: serverError, stdinFd: stdinError}
+
+  input = [serverSocket, stdinFd]
+  error = [serverSocket, stdinFd]
+
+  flag = True
+  try:
+    while flag:
+      output = []
+      if proxy.write.hasServerData(): output.append(serverSocket)
+      if proxy.write.stdoutBlocked(): output.append(stdoutFd)
+
+      try:
+        (i, o, e) = select.select(input, output, error, proxy.write.stdoutTimeout())
+      except select.error as e:
+        if e.args[0] == errno.EINTR: continue
+        log.error("Handling exception: " + str(e))
+        break
+      except BaseException as e:
+        log.error("Handling exception: " + str(e))
+        break
+
+      for oo in o:
+        if not outputHandlers[oo]():
+          flag = False
+
+      for ii in i:
+        if not inputHandlers[ii]():
+          flag = False
+
+      for ee in e:
+        if not errorHandlers[ee]():
+          flag = False
+
+      # one write for all the frames received during this iteration
+      timeout = proxy.write.stdoutTimeout()
+      if timeout != None and timeout <= 0:
+        if not proxy.write.flushStdout():
+          flag = False
+
+  finally:
+    proxy.write.drain()
+    fcntl.fcntl(stdinFd, fcntl.F_SETFL, stdinFlags)
+    fcntl.fcntl(stdoutFd, fcntl.F_SETFL, stdoutFlags)
 
 if __name__ == "__main__":
   r = main()
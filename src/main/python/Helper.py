@@ -19,6 +19,8 @@ import sys
 import traceback
 import re
 import logging
+import threading
+import collections
 
 #
 # Simple Singleton decorator
@@ -37,11 +39,16 @@ class LogSetup:
 
   FORMAT = '%(asctime)s %(levelname)s [%(name)s] %(message)s' # (%(funcName)s(), %(filename)s:%(lineno)d)'
 
+  # level of the loggers unless given to setup()
+  DEFAULT_LEVEL = logging.INFO
+
   def __init__(self):
     self.handlers = {} # {name: handler}
 
-  def setup(self, loggerName, logFilename = None, stdout = False):
+  def setup(self, loggerName, logFilename = None, stdout = False, level = None):
     self.initLogger(loggerName)
+    if level != None:
+      self.setLevel(loggerName, level)
 
     if logFilename != None and logFilename != '':
       self.addFileHandler(loggerName, logFilename)
@@ -67,9 +74,20 @@ class LogSetup:
     if not self.handlers.has_key(name):
       self.handlers[name] = {}
 
-      log.setLevel(logging.DEBUG)
+      log.setLevel(self.DEFAULT_LEVEL)
       log.propagate = False
 
+  def setLevel(self, loggerName, level):
+    logging.getLogger(loggerName).setLevel(level)
+
+  # Trace channels: debug messages of a subsystem (e.g. every protocol frame),
+  # logged by traceLogger(loggerName, subsystem). They follow the logger level
+  # until switched on or off, independently of the other debug messages.
+  def setTrace(self, loggerName, subsystem, enabled = True):
+    if enabled: level = logging.DEBUG
+    else: level = logging.INFO
+    traceLogger(loggerName, subsystem).setLevel(level)
+
   def addHandler(self, loggerName, handlerName, handlerCreator):
     if self.handlers.has_key(loggerName) and not self.handlers[loggerName].has_key(handlerName):
       try:
@@ -98,22 +116,129 @@ class LogSetup:
   def removeFileHandler(self, loggerName):
     self.removeHandler(loggerName, 'fileHandler')
 
+def traceLogger(loggerName, subsystem):
+  return logging.getLogger(loggerName + '.trace.' + subsystem)
+
 def CatchAndLogException(mth):
   def methodWrapper(*args, **kwargs):
-    # forward exception on all registered loggers or use a basic configuration
-    if LogSetup().hasLogger():
-      logs = [logging.getLogger(name) for name in LogSetup().loggerNames()]
-    else:
-      logging.basicConfig()
-      logs = [logging.getLogger()]
     try:
       return mth(*args, **kwargs)
     except:
-      for log in logs:
-        log.exception("[ CatchAndLogException ]")
+      logException()
 
   return methodWrapper
 
+# forward the current exception on all registered loggers or use a basic configuration
+# (loggers are only looked up once an exception occurred, see CatchAndLogException)
+def logException():
+  if LogSetup().hasLogger():
+    logs = [logging.getLogger(name) for name in LogSetup().loggerNames()]
+  else:
+    logging.basicConfig()
+    logs = [logging.getLogger()]
+
+  for log in logs:
+    log.exception("[ CatchAndLogException ]")
+
+#
+# UTF-8 helpers
+#
+# Swank headers give the length of the data in characters: these helpers
+# count characters directly on utf-8 encoded data, without decoding it.
+# A character is any byte which is not a continuation byte (10xxxxxx).
+reNonAscii = re.compile('[\x80-\xff]')
+reUtf8Continuation = re.compile('[\x80-\xbf]')
+reUtf8Continuations = re.compile('[\x80-\xbf]*')
+
+# number of characters in data[start:end]
+def utf8Length(data, start = 0, end = None):
+  if end == None: end = len(data)
+  if isinstance(data, unicode) or not reNonAscii.search(data, start, end):
+    return end - start
+  return end - start - len(reUtf8Continuation.findall(data, start, end))
+
+# advance of count characters from start, without going further than end
+# return (position, number of characters read)
+def utf8Advance(data, start, count, end = None):
+  if end == None: end = len(data)
+  if isinstance(data, unicode):
+    pos = min(start + count, end)
+    return (pos, pos - start)
+
+  pos = start
+  chars = 0
+  while chars < count and pos < end:
+    # there are at least as many bytes as characters left
+    nextPos = min(pos + count - chars, end)
+    chars += utf8Length(data, pos, nextPos)
+    pos = nextPos
+
+  # include the continuation bytes of the last character
+  pos = reUtf8Continuations.match(data, pos, end).end()
+  return (pos, chars)
+
+# number of continuation bytes missing to complete the last character of data
+def utf8Missing(data):
+  i = len(data) - 1
+  while i >= 0 and '\x80' <= data[i] <= '\xbf':
+    i -= 1
+  if i < 0: return 0
+
+  lead = ord(data[i])
+  if lead >= 0xf0: size = 4
+  elif lead >= 0xe0: size = 3
+  elif lead >= 0xc0: size = 2
+  else: size = 1
+  return max(0, size - (len(data) - i))
+
+# Bounded mapping: once full, the least recently used entries are evicted
+# (used by the Swank caches, entries may be read and filled from several threads)
+class LruCache(object):
+  def __init__(self, maxSize):
+    self.maxSize = maxSize
+    self.entries = collections.OrderedDict()  # key: value, least recently used first
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def __len__(self):
+    return len(self.entries)
+
+  def get(self, key, default = None):
+    with self.lock:
+      try:
+        value = self.entries.pop(key)
+      except KeyError:
+        self.misses += 1
+        return default
+      self.entries[key] = value
+      self.hits += 1
+      return value
+
+  def put(self, key, value):
+    with self.lock:
+      self.entries.pop(key, None)
+      self.entries[key] = value
+      while len(self.entries) > self.maxSize:
+        self.entries.popitem(last = False)
+
+  def remove(self, key):
+    with self.lock:
+      self.entries.pop(key, None)
+
+  # remove the entries for which fct(key) is true
+  def removeIf(self, fct):
+    with self.lock:
+      for key in [key for key in self.entries if fct(key)]:
+        del self.entries[key]
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+
+  def stats(self):
+    return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
 # list given object attributes, and call fct(attrname, obj.attr) for each of them
 # return the list of attributes as string
 def listObjectAttribute(obj, fct):
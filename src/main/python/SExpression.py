@@ -19,6 +19,7 @@
 
 import re
 import types
+import operator
 import logging
 
 from Helper import *
@@ -29,6 +30,8 @@ log = logging.getLogger('ensime-common')
 # S-Expression Python Object representation
 # Base object of S-Expression to python conversion
 class SExpPyObject(object):
+  __slots__ = ()
+
   def debugString(self):
     s = []
 
@@ -52,6 +55,87 @@ class SExpPyObject(object):
   def has(self, attrname):
     return hasattr(self, attrname)
 
+# Python object built from a keyword list: (:name "foo" :type-id 12)
+# The record is a tuple of values, attributes are read-only properties defined
+# by the record class of the keyword list shape (see SExpPyRecordShapes).
+class SExpPyRecord(tuple, SExpPyObject):
+  __slots__ = ()
+  _names = ()
+
+  def __dir__(self):
+    return list(self._names)
+
+  # e.g. SExpPyRecord(name='foo', type_id=12), in logs and error messages
+  def __repr__(self):
+    return 'SExpPyRecord(%s)' % ', '.join('%s=%r' % item for item in zip(self._names, self))
+
+  # records are equal when both their keywords and values are
+  def __eq__(self, other):
+    return isinstance(other, SExpPyRecord) and self._names == other._names and tuple.__eq__(self, other)
+
+  def __ne__(self, other):
+    return not self.__eq__(other)
+
+  def __hash__(self):
+    return hash((self._names, tuple(self)))
+
+  # a record is true even without any field, as any object
+  def __nonzero__(self):
+    return True
+
+  # tuple methods (count, index) are not fields
+  def has(self, attrname):
+    return attrname in self._names
+
+# Record classes cache, keyed by shape: the ordered tuple of keywords
+# Swank replies only use a few shapes (completion info, note, position...)
+# so a record class is created once per shape and then reused.
+@SimpleSingleton
+class SExpPyRecordShapes:
+  def __init__(self):
+    self.classes = {}   # keywords tuple: record class
+    self.counts = {}    # keywords tuple: number of records built
+    self.hits = 0
+    self.misses = 0
+
+  def recordClass(self, keywords):
+    cls = self.classes.get(keywords)
+
+    if cls != None:
+      self.hits += 1
+      self.counts[keywords] += 1
+      return cls
+
+    self.misses += 1
+    names = tuple(kw[1:].replace('-', '_') for kw in keywords)
+    attrs = {'__slots__': (), '_names': names}
+    for i, name in enumerate(names):
+      attrs[name] = property(operator.itemgetter(i))
+
+    cls = type('SExpPyRecord', (SExpPyRecord,), attrs)
+    self.classes[keywords] = cls
+    self.counts[keywords] = 1
+    return cls
+
+  def stats(self):
+    return {'hits': self.hits, 'misses': self.misses, 'shapes': len(self.classes)}
+
+  # list of (keywords, count), most used shapes first
+  def shapes(self):
+    return sorted(self.counts.items(), key=lambda it: it[1], reverse=True)
+
+  def clear(self):
+    self.classes = {}
+    self.counts = {}
+    self.hits = 0
+    self.misses = 0
+
+# Keyword decoded by SExpPyBuilder, e.g. ':ok'
+# Only used to tell keywords from strings while building records: it is
+# equal to and hashes like the plain string.
+class SExpPyKeyword(str):
+  __slots__ = ()
+
 # S-Expression
 class SExp(object):
   def __init__(self): pass
@@ -65,6 +149,9 @@ class SExpList(SExp):
   def __init__(self, items = []):
     self.items = items
   def __str__(self): return "SExpList"
+  def __len__(self): return len(self.items)
+  def __getitem__(self, i): return self.items[i]
+  def __iter__(self): return self.items.__iter__()
   def toWire(self): return '(' + ' '.join(sexp.toWire() for sexp in self.items) + ')'
   def debugString(self):
     s = "SExpList: "+'(' + "\n"
@@ -81,26 +168,27 @@ class SExpList(SExp):
         li.append(it.toValue())
     return li
   def _toPyObject(self):
-    attrs = {}
+    keywords = []
+    values = []
     it = self.items.__iter__()
 
-    while True:
-      try: v = it.next()
-      except: break
-
+    for v in it:
       if isinstance(v, KeywordAtom):
-        value = it.next()
+        value = next(it, None)
+        if value == None:
+          log.error("SExpList.toPy: keyword '"+v.toValue()+"' has no value")
+          break
         if isinstance(value, SExpList):
           value = value.toPy()
         else:
           value = value.toValue()
-        attrs[v.asName().replace('-','_')] = value
+        keywords.append(v.toValue())
+        values.append(value)
       else:
         # TODO: Not sure if it's printed in case (:return :ok () 42) -> what happen to 42??
         log.error("SExpList.toPy: cannot convert to object: '"+str(v)+"' is not a KeywordAtom")
-   
-    Ty = type('SExpPyObj', (SExpPyObject,), attrs)
-    return Ty()
+
+    return SExpPyRecordShapes().recordClass(tuple(keywords))(tuple(values))
   def hasKeyword(self):
     for it in self.items:
       if isinstance(it, KeywordAtom):
@@ -134,13 +222,26 @@ class TruthAtom(BooleanAtom):
   def toPy(self): return self.toBool()
   def toValue(self): return self.toBool()
 
+# String literals: only double-quote and backslash are escaped (with a backslash)
+reEscape = re.compile(r'["\\]')
+reUnescape = re.compile(r'\\(.)', re.S)
+
+def escapeString(s):
+  if '"' in s or '\\' in s:
+    return reEscape.sub(r'\\\g<0>', s)
+  return s
+
+def unescapeString(s):
+  if '\\' in s:
+    return reUnescape.sub(r'\1', s)
+  return s
+
 class StringAtom(SExp):
+  # value: the string itself, without double-quotes nor escaping
   def __init__(self, value):
-    if value[0] == '"' or value[0] == "'": value = value[1:]
-    if value[-1] == '"' or value[-1] == "'": value = value[:-1]
     self.value = value
   def __str__(self): return 'StringAtom'
-  def toWire(self): return '"'+self.value+'"'
+  def toWire(self): return '"'+escapeString(self.value)+'"'
   def toValue(self): return self.value
   def debugString(self): return "StringAtom: " + self.value
 
@@ -175,27 +276,56 @@ class KeywordAtom(SExp):
 
 @SimpleSingleton
 class SExpConverter:
+  # atoms are classified on their first character, no regexp involved
+  digits = frozenset('-0123456789')
+
   def __init__(self):
-    self.reList = re.compile('^\(.*\)$')
-    self.reInt = re.compile('^-?\d+$')
-    self.reKeyword = re.compile('^:[\w\-]+$')
-    self.reString = re.compile('^[\'"]{1}.*[\'"]{1}$')
+    pass
 
   def wireToSExp(self, s):
-    s = s.strip()
+    return self.tokenToSExp(s.strip())
+
+  def wireToPy(self, s):
+    return self.tokenToPy(s.strip())
 
-    if s == 'nil':
+  # token: atom text without surrounding blanks, as split by the parser
+  def tokenToSExp(self, s):
+    c = s[0]
+
+    if c == ':':
+      return KeywordAtom(s)
+    elif c in self.digits:
+      try: return IntAtom(int(s))
+      except ValueError: pass
+    elif s == 'nil':
       return NilAtom()
     elif s == 't':
       return TruthAtom()
-    elif self.reInt.match(s):
-      return IntAtom(int(s))
-    elif self.reKeyword.match(s):
-      return KeywordAtom(s)
-    elif self.reString.match(s):
-      return StringAtom(s)
-    else:
-      return StringAtom(s)
+
+    return StringAtom(self.tokenToString(s))
+
+  # same classification as tokenToSExp, without building the atom
+  def tokenToPy(self, s):
+    c = s[0]
+
+    if c == ':':
+      return SExpPyKeyword(s)
+    elif c in self.digits:
+      try: return int(s)
+      except ValueError: pass
+    elif s == 'nil':
+      return False
+    elif s == 't':
+      return True
+
+    return self.tokenToString(s)
+
+  # strip the quotes of a string literal token
+  def tokenToString(self, s):
+    if len(s) > 1 and s[0] == s[-1]:
+      if s[0] == '"': return unescapeString(s[1:-1])
+      if s[0] == "'": return s[1:-1]
+    return s
 
   def pyToSExp(self, py):
 
@@ -227,8 +357,7 @@ class SExpConverter:
     elif isinstance(py, types.DictType):
       items = []
       for key in py.keys():
-        key = key.replace('_', '-')
-        items.append(KeywordAtom(key))
+        items.append(KeywordAtom(key.replace('_', '-')))
         items.append(self.pyToSExp(py[key]))
       return SExpList(items)
     elif isinstance(py, SExpPyObject):
@@ -256,96 +385,394 @@ class SExpConverter:
       log.error("SExpConverter: given object is not a SExp")
       return None
 
-# Quick SExpression Parser specificaly adapted to ensime
-# A time will come when it will be re-implemented nicely
-# improving robustess and efficiency
-# TODO: make that time happen
-class SExpParser:
+  # python value to wire format: same rules as pyToSExp, but written straight
+  # into a single buffer without building the SExp tree
+  def pyToWire(self, py):
+    out = []
+    self._writePy(py, out)
+    return ''.join(out)
+
+  # python value to a Swank frame: length as 6 hex digits, then the data
+  # the frame is utf-8 encoded, the length is given in characters
+  def pyToFrame(self, py):
+    out = ['']
+    self._writePy(py, out)
+    out.append("\n")
+    out[0] = "%06x" % (sum(map(utf8Length, out)))
+    return ''.join(out)
+
+  # append the wire pieces of py to out, return False if py cannot be converted
+  def _writePy(self, py, out):
+
+    if isinstance(py, types.BooleanType):
+      # BooleanType are IntType too!
+      if py: out.append('t')
+      else: out.append('nil')
+    elif isinstance(py, types.IntType):
+      out.append(str(py))
+    elif isinstance(py, types.StringTypes):
+      py = py.strip()
+      if isinstance(py, types.UnicodeType):
+        py = py.encode('utf-8')
+      if py[:1] == ':' or py == 'nil' or py == 't' or py.startswith('swank:'):
+        out.append(py)
+      else:
+        out.append('"'+escapeString(py)+'"')
+    elif isinstance(py, types.ListType):
+      out.append('(')
+      first = True
+      for i in py:
+        if not first: out.append(' ')
+        if self._writePy(i, out): first = False
+        elif not first: out.pop()
+      out.append(')')
+    elif isinstance(py, types.DictType):
+      self._writePairs(py.items(), out)
+    elif isinstance(py, SExpPyObject):
+      pairs = []
+      listObjectAttribute(py, lambda attrname, pyattr: pairs.append((attrname, pyattr)))
+      self._writePairs(pairs, out)
+    elif isinstance(py, types.MethodType):
+      log.warn("pyToWire: Method cannot be converted to SExp")
+      return False
+    else:
+      log.error("pyToWire: argument ("+str(py)+") cannot be converted to SExp")
+      return False
+
+    return True
+
+  # write [(name, value)] as a keyword list
+  def _writePairs(self, pairs, out):
+    out.append('(')
+    first = True
+    for name, value in pairs:
+      n = len(out)
+      if not first: out.append(' ')
+      name = name.replace('_', '-')
+      if name[:1] != ':': out.append(':')
+      out.append(name)
+      out.append(' ')
+      if self._writePy(value, out): first = False
+      else: del out[n:]
+    out.append(')')
+
+# Parser builders
+# The parser delegates values creation to a builder:
+#   atom(token) -> value of a token (nil, t, integer, keyword, symbol)
+#   string(raw) -> value of a string literal (raw content between the double-quotes)
+#   closeList(items, stack) -> value of a list, stack holds the enclosing
+#     lists items: stack[-1] is the parent, stack[0] the top-level forms
+
+# Build the SExp tree: SExpList, IntAtom, StringAtom...
+class SExpTreeBuilder(object):
   def __init__(self):
-    pass
+    self.converter = SExpConverter()
+    # bound method: saves a call per token
+    self.atom = self.converter.tokenToSExp
 
-  def parse(self, s):
+  def string(self, raw):
+    return StringAtom(unescapeString(raw))
 
-    def matchingBracketPos(s):
-      inDoubleQuote = False
-      inQuote = False
-      found = False
-      cpt = 0
-      i = 0
-      max = len(s)
-
-      while not found and i < max:
-        if s[i] == '"':
-          inDoubleQuote = not inDoubleQuote
-        elif s[i] == "'":
-          inQuote = not inQuote
-        elif s[i] == "\\":
-          i += 1 # escape next char
-        elif not inDoubleQuote and not inQuote and s[i] == '(':
-          cpt += 1
-        elif not inDoubleQuote and not inQuote and s[i] == ')':
-          cpt -= 1
-          if cpt == 0: 
-            found = True
-            break
-        i += 1
-  
-      if found:
-        return i
-      return None
+  def closeList(self, items, stack):
+    return SExpList(items)
+
+# Build python values directly, as SExp.toPy() would return them:
+# lists, SExpPyRecord, int, bool and strings
+class SExpPyBuilder(object):
+  def __init__(self):
+    self.converter = SExpConverter()
+    self.shapes = SExpPyRecordShapes()
+    self.atom = self.converter.tokenToPy
+
+  def string(self, raw):
+    return unescapeString(raw)
+
+  def closeList(self, items, stack):
+    for it in items:
+      if type(it) is SExpPyKeyword:
+        return self.record(items)
+    return items
+
+  def record(self, items):
+    keywords = []
+    values = []
+    it = items.__iter__()
+
+    for v in it:
+      if type(v) is SExpPyKeyword:
+        value = next(it, None)
+        if value == None:
+          log.error("SExpPyBuilder.record: keyword '"+v+"' has no value")
+          break
+        keywords.append(v)
+        values.append(value)
+      else:
+        log.error("SExpPyBuilder.record: cannot convert to object: '"+str(v)+"' is not a keyword")
+
+    return self.shapes.recordClass(tuple(keywords))(tuple(values))
+
+# Incremental S-Expression Parser
+# Resumable version of the single pass parser: feed() accepts chunks of any
+# size and returns the top-level forms completed by that chunk. The stack, a
+# partial token and the string/escape state are kept between calls.
+class SExpStreamParser:
+  reToken = re.compile(r'[ \t\r\n]*(?:(\()|(\))|"([^"\\]*(?:\\.[^"\\]*)*)"|([^ \t\r\n()"]+))', re.S)
+  reBlank = re.compile(r'[ \t\r\n]*')
+  reStringBody = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.S)
+  reTokenTail = re.compile(r'[^ \t\r\n()"]*')
+
+  def __init__(self, builder = None):
+    if builder == None: builder = SExpTreeBuilder()
+    self.builder = builder
+    self.error = False    # set once malformed input has been seen
+    self.reset()
+
+  def reset(self):
+    self.stack = []       # enclosing lists items
+    self.items = []       # items of the list being parsed (top-level forms at depth 0)
+    self.token = ''       # atom split between two chunks
+    self.string = None    # pieces of a string split between chunks
+    self.escape = False   # string piece ended on a backslash
+
+  def pending(self):
+    return len(self.stack) > 0 or self.token != '' or self.string != None
+
+  def feed(self, data, start = 0, end = None):
+    if end == None: end = len(data)
+    pos = start
+
+    # resume a split string or token
+    if self.string != None:
+      pos = self._continueString(data, pos, end)
+      if pos == -1: return self._forms()
+      self.items.append(self.builder.string(''.join(self.string)))
+      self.string = None
+
+    elif self.token != '':
+      m = self.reTokenTail.match(data, pos, end)
+      self.token += m.group()
+      pos = m.end()
+      if pos == end: return self._forms()
+      self.items.append(self.builder.atom(self.token))
+      self.token = ''
+
+    match = self.reToken.match
+    stack = self.stack
+    items = self.items
+    atom = self.builder.atom
+    string = self.builder.string
+    closeList = self.builder.closeList
 
-    def subParse(s):
-      s = s.strip()
+    while True:
+      m = match(data, pos, end)
+      if m == None: break
+      pos = m.end()
+      kind = m.lastindex
+
+      if kind == 1:
+        stack.append(items)
+        items = []
+      elif kind == 2:
+        if len(stack) == 0:
+          log.error("SExpStreamParser.feed: unexpected closing bracket")
+          self.error = True
+          continue
+        value = closeList(items, stack)
+        items = stack.pop()
+        items.append(value)
+      elif kind == 3:
+        items.append(string(m.group(3)))
+      elif pos == end:
+        # token may continue in the next chunk
+        self.token = m.group(4)
+        break
+      else:
+        items.append(atom(m.group(4)))
 
-      items = []
-      i = 0
-      max = len(s)
-      flag = True
-
-      beginToken = -1
-
-      while i < max:
-        
-        if s[i] == '(':
-          end = matchingBracketPos(s[i:])
-          if end == None:
-            log.error("subParse: cannot find matching bracket! abording!")
-            return SExpList([])
-          else:
-            end += i
-            items.append(subParse(s[i+1:end]))
-            i = end + 1
-      
-        elif s[i] == '"':
-          # TODO: What about \" here?
-          end = s.find('"', i+1)
-          if end == -1:
-            log.error("subParse: cannot find matching double-quote! abording!")
-            return SExpList([])
-          else:
-            end += 1
-            items.append(SExpConverter().wireToSExp(s[i:end]))
-            i = end + 1
-
-        elif s[i] == ' ' or s[i] == "\n" or s[i] == "\t":
-          if beginToken != -1:
-            items.append(SExpConverter().wireToSExp(s[beginToken:i]))
-            beginToken = -1
-          i += 1
+    self.items = items
 
-        else:
-          if beginToken == -1:
-            beginToken = i
-          i += 1
+    if self.token == '':
+      pos = self.reBlank.match(data, pos, end).end()
+      if pos < end:
+        # only an unterminated string can stop the scanner
+        self.string = []
+        self._continueString(data, pos + 1, end)
+
+    return self._forms()
+
+  def finish(self):
+    if self.token != '':
+      self.items.append(self.builder.atom(self.token))
+      self.token = ''
+
+    if self.string != None:
+      log.error("SExpStreamParser.finish: cannot find matching double-quote!")
+      self.error = True
+    elif len(self.stack) > 0:
+      log.error("SExpStreamParser.finish: cannot find matching bracket!")
+      self.error = True
+
+    forms = self._forms()
+    self.reset()
+    return forms
+
+  def _forms(self):
+    # completed forms are the items at depth 0
+    if len(self.stack) > 0:
+      forms = self.stack[0]
+      self.stack[0] = []
+    else:
+      forms = self.items
+      self.items = []
+    return forms
+
+  # consume string content, return the position after the closing
+  # double-quote, or -1 if the string continues in the next chunk
+  def _continueString(self, data, pos, end):
+    if self.escape:
+      if pos == end: return -1
+      self.string.append(data[pos])
+      self.escape = False
+      pos += 1
+
+    m = self.reStringBody.match(data, pos, end)
+    self.string.append(m.group())
+    pos = m.end()
+
+    if pos == end: return -1
+    if data[pos] == '\\':
+      # trailing backslash: the escaped character is in the next chunk
+      self.string.append('\\')
+      self.escape = True
+      return -1
+    return pos + 1
+
+# S-Expression Parser
+class SExpParser:
+  def __init__(self):
+    pass
 
-      if beginToken != -1:
-        items.append(SExpConverter().wireToSExp(s[beginToken:i]))
+  # parse into a SExp tree
+  def parse(self, s):
+    return self._parse(s, SExpTreeBuilder(), SExpList([]))
+
+  # parse directly into python values (see SExpPyBuilder)
+  def parsePy(self, s):
+    return self._parse(s, SExpPyBuilder(), None)
+
+  # parse lazily: lists children are parsed on access (see SExpLazyList)
+  def parseLazy(self, s):
+    m = SExpStreamParser.reBlank.match(s)
+    if s[m.end():m.end()+1] != '(':
+      return self.parse(s)
+    return SExpLazyList(s, m.end() + 1, SExpTreeBuilder())
+
+  def _parse(self, s, builder, onError):
+    parser = SExpStreamParser(builder)
+    forms = parser.feed(s)
+    forms.extend(parser.finish())
+
+    if parser.error:
+      log.error("SExpParser.parse: malformed S-Expression, abording!")
+      return onError
+
+    if len(forms) == 0:
+      log.error("SExpParser.parse: no S-Expression found")
+      return onError
+
+    return forms[0]
+
+# Lazy S-Expression List
+# Keep a reference to the source buffer and parse children only when they are
+# reached by indexing, iteration or toItems(). Nested lists are not parsed:
+# their span is found by looking at brackets outside of strings, and they
+# become SExpLazyList themselves.
+class SExpLazyList(SExpList):
+  reSkip = re.compile(r'[^()"]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^()"]*)*([()])', re.S)
+
+  # start: position following the opening bracket in buffer
+  def __init__(self, buffer, start, builder):
+    self.buffer = buffer
+    self.start = start
+    self.end = None       # position of the closing bracket, once reached
+    self.builder = builder
+    self.children = []    # children parsed so far
+    self.pos = start      # scan position of the next child
+
+  def __str__(self): return "SExpLazyList"
+
+  def __len__(self):
+    self._scan(None)
+    return len(self.children)
+
+  def __getitem__(self, i):
+    if isinstance(i, slice) or i < 0:
+      return self.toItems()[i]
+    self._scan(i + 1)
+    return self.children[i]
+
+  def __iter__(self):
+    i = 0
+    while True:
+      self._scan(i + 1)
+      if i >= len(self.children): return
+      yield self.children[i]
+      i += 1
 
-      #if len(items) == 0:
-      #  print("error: subParse: no items!")
-      
-      return SExpList(items)
+  @property
+  def items(self):
+    return self.toItems()
 
-    return subParse(s).items[0]
+  def toItems(self):
+    self._scan(None)
+    return self.children
 
+  def toWire(self):
+    self._scan(None)
+    return self.buffer[self.start-1:self.end+1]
 
+  def toPy(self):
+    # decode the list text straight to python values
+    return SExpParser().parsePy(self.toWire())
+
+  # parse children until count of them are available (all if count is None)
+  def _scan(self, count):
+    match = SExpStreamParser.reToken.match
+    buffer = self.buffer
+
+    while self.end == None and (count == None or len(self.children) < count):
+      m = match(buffer, self.pos)
+      if m == None:
+        log.error("SExpLazyList: malformed S-Expression at %d" % self.pos)
+        self.end = len(buffer) - 1
+        return
+
+      kind = m.lastindex
+      self.pos = m.end()
+
+      if kind == 1:
+        end = self._skip(self.pos)
+        self.children.append(SExpLazyList(buffer, self.pos, self.builder))
+        self.pos = end + 1
+      elif kind == 2:
+        self.end = self.pos - 1
+      elif kind == 3:
+        self.children.append(self.builder.string(m.group(3)))
+      else:
+        self.children.append(self.builder.atom(m.group(4)))
+
+  # return the position of the bracket closing the list starting at pos
+  def _skip(self, pos):
+    match = self.reSkip.match
+    depth = 1
+
+    while depth > 0:
+      m = match(self.buffer, pos)
+      if m == None:
+        log.error("SExpLazyList: cannot find matching bracket!")
+        return len(self.buffer) - 1
+      pos = m.end()
+      if m.group(1) == '(': depth += 1
+      else: depth -= 1
+
+    return pos - 1
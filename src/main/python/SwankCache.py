@@ -0,0 +1,250 @@
+# SwankCache.py
+#
+# Copyright 2012 Jeanluc Chasseriau <jeanluc@lo.cx>
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# SwankCompletionCache usage:
+# Completing "foo.ba", the member access point (after the dot) is at offset:
+#   SwankCompletionCache().completions(filename, offset, "ba", version, 100, False)(Handler())
+#
+# The next keystroke is answered from the cached completions of "ba":
+#   SwankCompletionCache().completions(filename, offset, "bar", version, 100, False)(Handler())
+#
+# SwankSymbolCache usage:
+# span: (start, end) offsets of the identifier at offset, hovering anywhere
+# in the identifier reuses the same response:
+#   SwankSymbolCache().symbolAtPoint(filename, offset, span, version)(Handler())
+#   SwankSymbolCache().usesOfSymbolAtPoint(filename, offset, span, version)(Handler())
+#
+# version: any value changing with the file content seen by the server.
+# On edits and typecheck, cached responses of the file are dropped:
+#   invalidateFile(filename)
+#   typecheckFile(filename)(Handler())
+#
+# Cached symbols are dropped on compiler-ready and clear-all-scala-notes events,
+# everything can be dropped with:
+#   invalidateAll()
+
+import bisect
+
+from SwankProtocol import *
+from Helper import SimpleSingleton, LruCache
+
+# ensime-common should be initialized with LogSetup
+log = logging.getLogger('ensime-common')
+
+# Completions returned by the server for a prefix, sorted by name to find
+# the completions of a longer prefix with a binary search.
+class SwankCompletionList(object):
+  def __init__(self, response, prefix, limit, case):
+    self.response = response
+    self.prefix = prefix
+    self.limit = limit
+    self.case = case
+
+    self.items = self.completionsOf(response)
+    # the server stops at limit: the completions of a longer prefix may be missing
+    self.complete = len(self.items) < limit
+
+    keyed = sorted((self.key(item.name), i) for (i, item) in enumerate(self.items))
+    self.keys = [k for (k, i) in keyed]
+    self.indexes = [i for (k, i) in keyed]
+
+  # response is either a list of completions or (:prefix "ba" :completions (...))
+  @staticmethod
+  def completionsOf(response):
+    if isinstance(response, SExpPyRecord):
+      return response.completions or []
+    return response or []
+
+  def key(self, name):
+    if self.case: return name
+    return name.lower()
+
+  def covers(self, prefix, limit):
+    p = self.key(prefix)
+    cached = self.key(self.prefix)
+    if not p.startswith(cached):
+      return False
+    return self.complete or (p == cached and limit <= self.limit)
+
+  # completions of prefix, in the order given by the server
+  def filter(self, prefix, limit):
+    p = self.key(prefix)
+    start = bisect.bisect_left(self.keys, p)
+    end = bisect.bisect_right(self.keys, p + '\xff', start)
+    items = [self.items[i] for i in sorted(self.indexes[start:end])[:limit]]
+
+    if not isinstance(self.response, SExpPyRecord):
+      return items
+
+    # same record shape as the server response
+    values = list(self.response)
+    values[self.response._names.index('completions')] = items
+    if 'prefix' in self.response._names:
+      values[self.response._names.index('prefix')] = prefix
+    return type(self.response)(values)
+
+# Call fill(response) before forwarding the response to handler
+class SwankCacheHandler(SwankCallHandler):
+  def __init__(self, fill, handler):
+    self.fill = fill
+    self.handler = handler
+
+  def response(self, response):
+    self.fill(response)
+    self.handler.response(response)
+  def abort(self, code, details):
+    self.handler.abort(code, details)
+  def timeout(self):
+    self.handler.timeout()
+  def superseded(self):
+    self.handler.superseded()
+
+@SimpleSingleton
+class SwankCompletionCache(object):
+
+  MaxEntries = 32
+
+  def __init__(self):
+    self.cache = LruCache(self.MaxEntries) # (filename, offset, version, case): SwankCompletionList
+    self.generation = 0   # incremented on invalidation: responses of older calls are not kept
+    self.hits = 0
+    self.misses = 0
+
+  # same as SwankRpc().completions(filename, offset + len(prefix), limit, case)
+  # offset: member access point, where prefix starts
+  def completions(self, filename, offset, prefix, version, limit, case):
+
+    def handlerMethod(handler = None):
+      future = None
+      if handler == None:
+        future = SwankFuture()
+        handler = SwankFutureHandler(future)
+
+      key = (filename, offset, version, case)
+      cached = self.cache.get(key)
+
+      if cached != None and cached.covers(prefix, limit):
+        self.hits += 1
+        handler.response(cached.filter(prefix, limit))
+        return future
+
+      self.misses += 1
+      generation = self.generation
+
+      def fill(response):
+        if generation == self.generation:
+          self.cache.put(key, SwankCompletionList(response, prefix, limit, case))
+
+      SwankRpc().completions(filename, offset + len(prefix), limit, case)(SwankCacheHandler(fill, handler))
+      return future
+
+    return handlerMethod
+
+  # the file has been edited
+  def invalidate(self, filename):
+    self.generation += 1
+    self.cache.removeIf(lambda key: key[0] == filename)
+
+  def clear(self):
+    self.generation += 1
+    self.cache.clear()
+
+  def stats(self):
+    return {'hits': self.hits, 'misses': self.misses, 'size': len(self.cache)}
+
+@SimpleSingleton
+class SwankSymbolCache(object):
+
+  MaxEntries = 256
+
+  def __init__(self):
+    self.cache = LruCache(self.MaxEntries) # (method, filename, span, version): response
+    self.generation = 0   # incremented on invalidation: responses of older calls are not kept
+
+    for eventName in ['compiler-ready', 'clear-all-scala-notes']:
+      SwankProcessor().registerEvent(KeywordAtom(eventName), lambda *args: self.clear())
+
+  # same as SwankRpc().symbolAtPoint(filename, offset)
+  def symbolAtPoint(self, filename, offset, span, version):
+    return self.lookup('symbolAtPoint', filename, offset, span, version)
+
+  # same as SwankRpc().usesOfSymbolAtPoint(filename, offset)
+  def usesOfSymbolAtPoint(self, filename, offset, span, version):
+    return self.lookup('usesOfSymbolAtPoint', filename, offset, span, version)
+
+  # method: name of the SwankRpc method
+  def lookup(self, method, filename, offset, span, version):
+
+    def handlerMethod(handler = None):
+      future = None
+      if handler == None:
+        future = SwankFuture()
+        handler = SwankFutureHandler(future)
+
+      key = (method, filename, tuple(span), version)
+      cached = self.cache.get(key, self)
+
+      if cached is not self:
+        handler.response(cached)
+        return future
+
+      generation = self.generation
+
+      def fill(response):
+        if generation == self.generation:
+          self.cache.put(key, response)
+
+      getattr(SwankRpc(), method)(filename, offset)(SwankCacheHandler(fill, handler))
+      return future
+
+    return handlerMethod
+
+  def invalidate(self, filename):
+    self.generation += 1
+    self.cache.removeIf(lambda key: key[1] == filename)
+
+  def clear(self):
+    self.generation += 1
+    self.cache.clear()
+
+  def stats(self):
+    return self.cache.stats()
+
+# the file has been edited
+def invalidateFile(filename):
+  SwankCompletionCache().invalidate(filename)
+  SwankSymbolCache().invalidate(filename)
+
+# e.g. on compiler-ready and clear-all-scala-notes events
+def invalidateAll():
+  SwankCompletionCache().clear()
+  SwankSymbolCache().clear()
+
+# swank:typecheck-file, the cached responses of the file are dropped when the
+# call is sent and again once it is done
+def typecheckFile(filename):
+  invalidateFile(filename)
+
+  def handlerMethod(handler = None):
+    future = None
+    if handler == None:
+      future = SwankFuture()
+      handler = SwankFutureHandler(future)
+
+    SwankRpc().typecheckFile(filename)(SwankCacheHandler(lambda response: invalidateFile(filename), handler))
+    return future
+
+  return handlerMethod
@@ -0,0 +1,110 @@
+# SwankConnection.py
+#
+# Copyright 2012 Jeanluc Chasseriau <jeanluc@lo.cx>
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# SwankConnection usage:
+# Direct connection to the swank server, for tools running outside of the editor:
+#   connection = SwankConnection.connect(port)
+#   connection.start()
+#
+#   # many calls can be in flight at once
+#   completions = SwankRpc().completions(filename, offset, 10, False)()
+#   symbol = SwankRpc().symbolAtPoint(filename, offset)()
+#   print(completions.result(), symbol.result())
+#
+#   # events, in the order they arrive
+#   notes = connection.eventQueue("scala-notes")
+#   args = notes.get()
+#
+#   # calls still pending when the connection ends raise SwankAbort
+#   connection.close()
+
+import socket
+import select
+import threading
+import Queue
+
+from SwankProtocolHelper import *
+
+# ensime-common should be initialized with LogSetup
+log = logging.getLogger('ensime-common')
+
+# Socket transport for SwankProcessor: calls are written by the calling threads,
+# a reader thread feeds SwankProcessor.process() which resolves the SwankFuture
+# of each call and dispatches events.
+class SwankConnection(object):
+  READ_SIZE = 256 * 1024
+  EXPIRE_PERIOD = 0.5 # seconds
+
+  def __init__(self, sock):
+    self.socket = sock
+    self.writeLock = threading.Lock()
+    self.thread = None
+    self.running = False
+
+  @staticmethod
+  def connect(port, host = "localhost"):
+    return SwankConnection(socket.create_connection((host, port)))
+
+  def start(self):
+    SwankProcessor().setSendFunction(self.send)
+    self.running = True
+    self.thread = threading.Thread(target = self.run, name = "SwankConnection")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def close(self):
+    self.running = False
+    try: self.socket.shutdown(socket.SHUT_RDWR)
+    except socket.error: pass
+    self.socket.close()
+    if self.thread != None and self.thread != threading.current_thread():
+      self.thread.join()
+
+  def send(self, data):
+    with self.writeLock:
+      self.socket.sendall(data)
+
+  def run(self):
+    while self.running:
+      try:
+        # wake up regularly to expire calls waiting for a response
+        (readable, w, e) = select.select([self.socket], [], [], self.EXPIRE_PERIOD)
+        if len(readable) == 0:
+          SwankProcessor().expire()
+          continue
+
+        data = self.socket.recv(self.READ_SIZE)
+      except (socket.error, select.error) as e:
+        if self.running:
+          log.error("SwankConnection.run: unable to read from server: " + str(e))
+        break
+
+      if data == '':
+        log.info("SwankConnection.run: connection closed by server")
+        break
+
+      SwankProcessor().process(data)
+
+    self.running = False
+    # no response can arrive anymore
+    SwankProcessor().abortAll("connection closed")
+
+  # register a handler for eventName which queues the event arguments
+  # return the Queue.Queue receiving them
+  def eventQueue(self, eventName):
+    queue = Queue.Queue()
+    SwankProcessor().registerEvent(KeywordAtom(eventName), lambda *args: queue.put(args))
+    return queue
@@ -61,7 +61,8 @@ class SwankRpc:
 
   #@SwankMethod("swank:import-suggestions")
 
-  @SwankMethod("swank:completions")
+  # only the newest completions of a file matter: older ones are cancelled
+  @SwankMethod("swank:completions", supersede = lambda filename, *args: filename)
   def completions(filename, offset, limit, case): pass
 
   @SwankMethod("swank:uses-of-symbol-at-point")
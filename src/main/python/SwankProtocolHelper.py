@@ -14,34 +14,138 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from Helper import SimpleSingleton
+import re
+import time
+import heapq
+import itertools
+import collections
+import threading
+
+from Helper import SimpleSingleton, traceLogger, utf8Advance
 from SExpression import *
+from SwankStats import SwankStats
 
 # ensime-common should be initialized with LogSetup
 log = logging.getLogger('ensime-common')
+# every call, response and event: LogSetup().setTrace('ensime-common', 'protocol')
+trace = traceLogger('ensime-common', 'protocol')
 
 # Response handler class
 class SwankCallHandler(object):
   def __init__(self): pass
   def response(self, response): pass
   def abort(self, code, details): pass
+  # no response arrived before the call deadline (see SwankProcessor.setTimeout)
+  def timeout(self): pass
+  # a newer call with the same supersede key has been sent (see SwankMethod)
+  def superseded(self): pass
+
+# Raised by SwankFuture.result() when the call has been aborted
+class SwankAbort(Exception):
+  def __init__(self, code, details):
+    Exception.__init__(self, "call aborted (%s): %s" % (code, details))
+    self.code = code
+    self.details = details
+
+# Raised by SwankFuture.result() when no response arrived in time
+class SwankTimeout(Exception): pass
+
+# Raised by SwankFuture.result() when the call has been cancelled
+class SwankCancelled(Exception): pass
+
+# Result of a call, which can be waited on from any thread
+# (responses are delivered by whoever runs SwankProcessor.process, e.g. SwankConnection)
+class SwankFuture(object):
+  def __init__(self):
+    self.condition = threading.Condition()
+    self.finished = False
+    self.response = None
+    self.error = None       # SwankAbort, SwankTimeout or SwankCancelled
+    self.callbacks = []     # fct(future)
+    self.callId = None
+
+  def done(self):
+    return self.finished
+
+  # cancel the call: a late response is dropped, result() raises SwankCancelled
+  def cancel(self):
+    if self.callId != None:
+      SwankProcessor().cancel(self.callId)
+    self._finish(None, SwankCancelled("call cancelled"))
+
+  # wait for the response and return it, raise SwankAbort if the call has been aborted
+  def result(self, timeout = None):
+    with self.condition:
+      if not self.finished:
+        self.condition.wait(timeout)
+      if not self.finished:
+        raise SwankTimeout("no response after %s seconds" % timeout)
+
+    if self.error != None:
+      raise self.error
+    return self.response
+
+  # call fct(future) once the future is done
+  def addCallback(self, fct):
+    with self.condition:
+      if not self.finished:
+        self.callbacks.append(fct)
+        return
+    fct(self)
+
+  def setResponse(self, response):
+    self._finish(response, None)
+
+  def setAbort(self, code, details):
+    self._finish(None, SwankAbort(code, details))
+
+  def setTimeout(self):
+    self._finish(None, SwankTimeout("no response before the call deadline"))
+
+  def _finish(self, response, error):
+    with self.condition:
+      if self.finished: return
+      self.finished = True
+      self.response = response
+      self.error = error
+      callbacks = self.callbacks
+      self.callbacks = []
+      self.condition.notify_all()
+
+    for fct in callbacks:
+      fct(self)
+
+# Handler resolving a SwankFuture
+class SwankFutureHandler(SwankCallHandler):
+  def __init__(self, future):
+    self.future = future
+  def response(self, response):
+    self.future.setResponse(response)
+  def abort(self, code, details):
+    self.future.setAbort(code, details)
+  def timeout(self):
+    self.future.setTimeout()
+  def superseded(self):
+    self.future.cancel()
 
 # Represent a Call
 class SwankCall(object):
   # the ultimate answer to Life, the Universe and Everything
-  __nextCallId__ = 42
+  # (itertools.count: calls are made from several threads, see SwankConnection)
+  __callIds__ = itertools.count(42)
 
   @staticmethod
   def nextCallId():
-    n = SwankCall.__nextCallId__
-    SwankCall.__nextCallId__ += 1
-    return n
+    return next(SwankCall.__callIds__)
 
   def __init__(self):
     self.caller = "" # e.g. swank-rpc
     self.method = "" # e.g. swank:connection-info
     self.args = None # swank-rpc arguments as list of python object
     self.handler = None # SwankCallHandler
+    self.timeout = None # seconds to wait for the response, None: processor default
+    self.sentTime = None # time.time() when sent
+    self.supersede = None # key: a newer call with the same key cancels this one
     self.callId = SwankCall.nextCallId()
 
   def setCaller(self, caller):
@@ -56,7 +160,13 @@ class SwankCall(object):
   def setHandler(self, handler):
     self.handler = handler
 
-  def asSExp(self):
+  def setTimeout(self, timeout):
+    self.timeout = timeout
+
+  def setSupersede(self, key):
+    self.supersede = key
+
+  def asPy(self):
     items = []
     items.append(self.caller)
     subItems = []
@@ -64,11 +174,79 @@ class SwankCall(object):
     subItems.extend(self.args)
     items.append(subItems)
     items.append(self.callId)
-    return SExpConverter().pyToSExp(items)
+    return items
+
+  def asSExp(self):
+    return SExpConverter().pyToSExp(self.asPy())
+
+  # complete Swank frame (header + data) ready to be sent
+  def asFrame(self):
+    return SExpConverter().pyToFrame(self.asPy())
 
   def send(self):
     SwankProcessor().send(self)
 
+# Handler of a call sent within a SwankBatch
+class SwankBatchHandler(SwankCallHandler):
+  def __init__(self, batch, index, handler):
+    self.batch = batch
+    self.index = index
+    self.handler = handler
+  def response(self, response):
+    self.handler.response(response)
+    self.batch.done(self.index, response)
+  def abort(self, code, details):
+    self.handler.abort(code, details)
+    self.batch.done(self.index, SwankAbort(code, details))
+  def timeout(self):
+    self.handler.timeout()
+    self.batch.done(self.index, SwankTimeout("no response before the call deadline"))
+  def superseded(self):
+    self.handler.superseded()
+    self.batch.done(self.index, SwankCancelled("call superseded"))
+
+# Calls sent together, in a single write:
+#   batch = SwankBatch()
+#   for filename in filenames:
+#     batch.add(SwankRpc().typecheckFile(filename))
+#   results = batch.send().result()
+class SwankBatch(object):
+  def __init__(self):
+    self.calls = []
+    self.results = []
+    self.left = 0
+    self.lock = threading.Lock()
+    self.future = SwankFuture()
+
+  # method: e.g. SwankRpc().typecheckFile(filename), handler: as for the method
+  # return the SwankFuture of the call when no handler is given
+  def add(self, method, handler = None):
+    return method(handler, self)
+
+  def addCall(self, call):
+    call.setHandler(SwankBatchHandler(self, len(self.calls), call.handler))
+    self.calls.append(call)
+    self.results.append(None)
+
+  # send the calls, return a SwankFuture resolved once all calls are done with
+  # the list of their responses (SwankAbort, SwankTimeout or SwankCancelled on error)
+  def send(self):
+    self.left = len(self.calls)
+    if self.left == 0:
+      self.future.setResponse([])
+    else:
+      SwankProcessor().sendBatch(self.calls)
+    return self.future
+
+  def done(self, index, result):
+    with self.lock:
+      self.results[index] = result
+      self.left -= 1
+      finished = (self.left == 0)
+
+    if finished:
+      self.future.setResponse(self.results)
+
 # Represent an event
 class SwankEvent(object):
   def event(self, *args): pass
@@ -84,21 +262,36 @@ def SwankCaller(name):
   return nest
 
 # Decorator: define a SwankMethod within a SwankCaller
-def SwankMethod(name):
+# SwankRpc().method(args)(handler) sends the call, the response goes to handler
+# SwankRpc().method(args)() sends the call and returns a SwankFuture
+# SwankRpc().method(args)(handler, batch) adds the call to a SwankBatch
+# supersede: fct(*args) returning a key, a new call with the same key cancels
+# the previous one if it is still waiting for its response (e.g. completions)
+def SwankMethod(name, supersede = None):
 
   def nest(mth):
 
     # args are python objects (not SExp)
     def newMethod(self, *args):
 
-      def handlerMethod(handler):
+      def handlerMethod(handler = None, batch = None):
+        future = None
+        if handler == None:
+          future = SwankFuture()
+          handler = SwankFutureHandler(future)
+
         call = SwankCall()
         call.setCaller(':'+self.__SwankCaller__)
         call.setMethod(name)
         call.setArgs(args)
         call.setHandler(handler)
-        call.send()
-        return None
+        if supersede != None: call.setSupersede((name, supersede(*args)))
+        if future != None: future.callId = call.callId
+        if batch != None:
+          batch.addCall(call)
+        else:
+          call.send()
+        return future
 
       return handlerMethod
 
@@ -120,181 +313,488 @@ def SwankDefineEvent(name):
 
   return nest
 
+# Decode Swank messages straight to python values (see SExpPyBuilder)
+# The message envelope is kept as lists of python values:
+#   (:return (:ok value) callId)  -> [':return', [':ok', value], callId]
+#   (:event-name args...)         -> [':event-name', args...]
+class SwankMessageBuilder(SExpPyBuilder):
+  def closeList(self, items, stack):
+    depth = len(stack) - 1
+
+    if depth == 0:
+      return items
+    if depth == 1 and stack[1][:1] == [':return']:
+      return items
+
+    return SExpPyBuilder.closeList(self, items, stack)
 
 @SimpleSingleton
 class SwankProcessor(object):
 
+  # keep that many cancelled/expired callIds to drop their late responses quietly
+  MaxForgottenCalls = 1024
+  # for ForgetDelay seconds, or ForgetTimeouts times the call timeout when longer:
+  # a server which never replies does not hold back responses for the whole session
+  ForgetDelay = 60
+  ForgetTimeouts = 4
+
+  # abort code given to the handlers of calls which could not be sent or whose
+  # connection is lost (see abortAll)
+  ClientAbort = -1
+
   def __init__(self):
-    self.parser = SExpParser()
-    self.callHandler = {}     # callId: SwankCall
-    self.eventHandler = {}    # eventName: method
+    self.callHandler = collections.OrderedDict()  # callId: SwankCall, oldest first
+    self.eventHandler = {}    # eventName: list of subscribers, replaced on change
     self.sendFct = None       # function to execute 'send'
-    self.messages = self.BufferMessage()    # handle messages buffering
+    self.messages = self.BufferMessage(SwankMessageBuilder(), self.dropForgotten, self.isUnsubscribed, self.hasForgotten)    # handle messages buffering
+    self.timeout = None       # default call timeout in seconds (None: wait forever)
+    self.maxPending = 1000    # maximum number of calls waiting for a response
+    self.deadlines = []       # heap of (deadline, callId)
+    self.forgotten = collections.OrderedDict()  # callId: time until which the response of a cancelled or expired call is expected
+    self.superseding = {}     # supersede key: callId of the newest call
+    self.lock = threading.Lock()  # protect pending calls bookkeeping (see SwankConnection)
+    self.recorder = None      # SwankStats, see enableStats()
+    self.dumpPeriod = None    # seconds between two dumps of the stats to the log
+    self.nextDump = None
 
   def setSendFunction(self, fct):
     self.sendFct = fct
 
+  def setTimeout(self, timeout):
+    self.timeout = timeout
+
+  def setMaxPending(self, maxPending):
+    self.maxPending = maxPending
+
+  # record latencies, frame sizes and parse times (see SwankStats)
+  # dumpPeriod: seconds between two dumps to the log, None: no dump
+  def enableStats(self, dumpPeriod = None):
+    self.recorder = SwankStats()
+    self.messages.recorder = self.recorder
+    self.dumpPeriod = dumpPeriod
+    if dumpPeriod != None:
+      self.nextDump = time.time() + dumpPeriod
+
+  def disableStats(self):
+    self.recorder = None
+    self.messages.recorder = None
+    self.dumpPeriod = None
+
+  # None if stats are not enabled
+  def stats(self):
+    if self.recorder == None: return None
+    return self.recorder.snapshot()
+
+  # cancel a pending call: its handler will not be called
+  def cancel(self, callId):
+    with self.lock:
+      call = self.callHandler.pop(callId, None)
+      if call != None:
+        self.release(call)
+        self.forget(call)
+        return True
+    return False
+
+  # handle calls which reached their deadline (called by process() and send())
+  def expire(self, now = None):
+    if now == None: now = time.time()
+    expired = []
+
+    with self.lock:
+      while len(self.deadlines) > 0 and self.deadlines[0][0] <= now:
+        (deadline, callId) = heapq.heappop(self.deadlines)
+        call = self.callHandler.pop(callId, None)
+        if call != None:
+          self.release(call)
+          self.forget(call, now)
+          expired.append(call)
+
+      for (callId, until) in self.forgotten.items():
+        if until <= now:
+          del self.forgotten[callId]
+
+    for call in expired:
+      log.warn("Processor.expire: call %d (%s) timed out", call.callId, call.method)
+      call.handler.timeout()
+
+    recorder = self.recorder
+    if recorder != None and self.dumpPeriod != None and now >= self.nextDump:
+      self.nextDump = now + self.dumpPeriod
+      recorder.dump()
+
+  # remove calls which will not get a response, their handlers are aborted
+  def abortCalls(self, calls, details):
+    aborted = []
+    with self.lock:
+      for call in calls:
+        if self.callHandler.pop(call.callId, None) != None:
+          self.release(call)
+          aborted.append(call)
+
+    for call in aborted:
+      log.warn("Processor.abortCalls: call %d (%s): %s", call.callId, call.method, details)
+      call.handler.abort(self.ClientAbort, details)
+
+  # the connection is closed: abort all the pending calls
+  def abortAll(self, details):
+    with self.lock:
+      calls = self.callHandler.values()
+      self.forgotten.clear()
+    self.abortCalls(calls, details)
+
+  # a cancelled or expired call may still get its response
+  def hasForgotten(self):
+    return len(self.forgotten) > 0
+
+  # the response of callId arrived: True if it should be dropped
+  def dropForgotten(self, callId):
+    with self.lock:
+      return self.forgotten.pop(callId, None) != None
+
+  # the call left callHandler: its supersede key is free unless a newer call took it
+  def release(self, call):
+    if call.supersede != None and self.superseding.get(call.supersede) == call.callId:
+      del self.superseding[call.supersede]
+
+  def forget(self, call, now = None):
+    if now == None: now = time.time()
+    timeout = call.timeout
+    if timeout == None: timeout = self.timeout
+    delay = self.ForgetDelay
+    if timeout != None: delay = max(delay, self.ForgetTimeouts * timeout)
+
+    self.forgotten[call.callId] = now + delay
+    if len(self.forgotten) > self.MaxForgottenCalls:
+      self.forgotten.popitem(last = False)
+
+  # add a subscriber to an event: handler(*args)
   def registerEvent(self, keywordAtom, handler):
     kwValue = keywordAtom.toValue()
 
-    if self.eventHandler.has_key(kwValue):
-      log.warn("Processor.registerEvent: event '"+kwValue+"' is already registered")
+    log.debug("Processor.registerEvent: registering event: %s", kwValue)
+    with self.lock:
+      self.eventHandler[kwValue] = self.eventHandler.get(kwValue, []) + [handler]
+
+  def unregisterEvent(self, keywordAtom, handler):
+    kwValue = keywordAtom.toValue()
+
+    with self.lock:
+      handlers = [h for h in self.eventHandler.get(kwValue, []) if h != handler]
+      if len(handlers) > 0:
+        self.eventHandler[kwValue] = handlers
+      else:
+        self.eventHandler.pop(kwValue, None)
 
-    log.debug("Processor.registerEvent: registering event: " + kwValue)
-    self.eventHandler[kwValue] = handler
+  # events without subscriber are dropped before being parsed
+  def isUnsubscribed(self, eventName):
+    return not self.eventHandler.has_key(eventName)
 
-  def processReturn(self, sexpArgs, callId):
-    log.debug("Processor.processReturn: handling 'return': callId: "+str(callId))
+  def processReturn(self, args, callId):
+    trace.debug("Processor.processReturn: handling 'return': callId: %s", callId)
 
-    if not isinstance(sexpArgs, SExpList):
+    if not isinstance(args, types.ListType) or len(args) == 0:
       log.error("Processor.processReturn: response argument is not a list")
-      log.error("Processor.processReturn: " + sexpArgs.debugString())
+      log.error("Processor.processReturn: %s", args)
       return
 
-    if not self.callHandler.has_key(callId):
-      log.error("Processor.processReturn: callId ("+str(callId)+") not registered")
-      return
+    with self.lock:
+      call = self.callHandler.pop(callId, None)
+      if call != None:
+        self.release(call)
 
-    items = sexpArgs.toItems()
+    if call == None:
+      if self.dropForgotten(callId):
+        trace.debug("Processor.processReturn: dropping response of cancelled call (%s)", callId)
+      else:
+        log.error("Processor.processReturn: callId (%s) not registered", callId)
+      return
 
-    if items[0].toValue() == ":ok":
-      args = items[1].toPy()
+    recorder = self.recorder
+    if recorder != None:
+      start = time.time()
+      recorder.add('rtt ' + call.method, (start - call.sentTime) * 1000)
 
-      self.callHandler[callId].handler.response(args)
-      del(self.callHandler[callId])
+    if args[0] == ":ok":
+      call.handler.response(args[1])
 
-    elif items[0].toValue() == ":abort":
-      code = items[1].toValue()
-      details = items[2].toValue()
+    elif args[0] == ":abort":
+      code = args[1]
+      details = args[2]
 
-      self.callHandler[callId].handler.abort(code, details)
-      del(self.callHandler[callId])
+      call.handler.abort(code, details)
 
     else:
-      log.error("Processor.processReturn: unknown return value: "+items[0].toValue())
+      log.error("Processor.processReturn: unknown return value: %s", args[0])
+
+    if recorder != None:
+      recorder.add('handler ' + call.method, (time.time() - start) * 1000)
 
-  def processEvent(self, eventName, sexpItems):
-    if not self.eventHandler.has_key(eventName):
-      log.debug("Processor.processEvent: unregistered event: "+eventName)
+  def processEvent(self, eventName, pyItems):
+    handlers = self.eventHandler.get(eventName)
+    if handlers == None:
+      trace.debug("Processor.processEvent: unregistered event: %s", eventName)
       return
 
-    log.debug("Processor.processEvent: handling event: " + eventName)
+    trace.debug("Processor.processEvent: handling event: %s", eventName)
 
-    pyItems = []
-    for item in sexpItems:
-      if isinstance(item, SExpList):
-        pyItems.append(item.toPy())
-      else:
-        pyItems.append(item.toValue())
+    recorder = self.recorder
+    if recorder != None:
+      start = time.time()
+      recorder.count('event ' + eventName)
 
-    log.debug("Processor.processEvent: pyArgs: " + str(pyItems))
+    # arguments are decoded once, shared by all subscribers
+    for handler in handlers:
+      handler(*pyItems)
 
-    self.eventHandler[eventName](*pyItems)
+    if recorder != None:
+      recorder.add('handler ' + eventName, (time.time() - start) * 1000)
 
   @CatchAndLogException
   def process(self, data):
-    log.debug("Processor.process: len(data): %d - data: '%0.16s'" % (len(data), data))
+    trace.debug("Processor.process: len(data): %d - data: '%0.16s'", len(data), data)
 
+    self.expire()
     self.messages.add(data)
 
     while self.messages.has():
 
-      s = self.messages.get()
-
-      sexplist = self.parser.parse(s)
-      items = sexplist.toItems()
+      items = self.messages.get()
 
-      if isinstance(items[0], KeywordAtom):
+      if isinstance(items, types.ListType) and len(items) > 0 and type(items[0]) is SExpPyKeyword:
 
         # call response handling
-        if items[0].toValue() == ":return":
-          callId = items[2].toValue()
+        if items[0] == ":return":
+          callId = items[2]
 
           self.processReturn(items[1], callId)
 
         # event handling
         else:
-          eventName = items[0].toValue()
+          eventName = items[0]
 
           self.processEvent(eventName, items[1:])
 
       else:
-        log.error("Processor.process: unregognize first SExpression item: "+items[0].toValue())
-        log.error("Processor.process: SExp:"+sexplist.debugString())
+        log.error("Processor.process: unregognize message: %s", items)
 
 
   # send(swankCall)
   @CatchAndLogException
   def send(self, call):
-    
-    if self.callHandler.has_key(call.callId):
-      log.error("Processor.send: callId ("+str(call.callId)+") already registered")
-      return False
+    self.sendBatch([call])
+
+  # send all the calls in a single write (see SwankBatch)
+  @CatchAndLogException
+  def sendBatch(self, calls):
+    self.expire()
+    registered = []
+    dropped = []
+    superseded = []
+
+    with self.lock:
+      for call in calls:
+        if self.callHandler.has_key(call.callId):
+          log.error("Processor.send: callId (%d) already registered", call.callId)
+          continue
+
+        if call.supersede != None:
+          oldId = self.superseding.get(call.supersede)
+          self.superseding[call.supersede] = call.callId
+          old = self.callHandler.pop(oldId, None)
+          if old != None:
+            self.forget(old)
+            superseded.append((old, call))
+
+        if self.maxPending != None and len(self.callHandler) >= self.maxPending:
+          (oldId, old) = self.callHandler.popitem(last = False)
+          self.release(old)
+          self.forget(old)
+          dropped.append(old)
+
+        self.callHandler[call.callId] = call
+        registered.append(call)
+
+        timeout = call.timeout
+        if timeout == None: timeout = self.timeout
+        if timeout != None:
+          heapq.heappush(self.deadlines, (time.time() + timeout, call.callId))
+
+      # calls of this batch may have been superseded or dropped by later ones
+      registered = [call for call in registered if self.callHandler.has_key(call.callId)]
+
+    for call in dropped:
+      log.warn("Processor.send: too many pending calls, dropping call %d", call.callId)
+      call.handler.timeout()
+
+    for (old, call) in superseded:
+      trace.debug("Processor.send: call %d superseded by %d", old.callId, call.callId)
+      old.handler.superseded()
+
+    if len(registered) == 0:
+      return
 
-    self.callHandler[call.callId] = call
+    frames = ''.join([call.asFrame() for call in registered])
 
-    sexp = call.asSExp()
+    now = time.time()
+    for call in registered:
+      call.sentTime = now
+
+    if trace.isEnabledFor(logging.DEBUG):
+      trace.debug("Processor.send: calls (ids: %s)", ' '.join(str(call.callId) for call in registered))
+      trace.debug("Processor.send: frames: %s", frames[:-1])
 
-    log.debug("Processor.send: call (id:"+str(call.callId)+")")
-    log.debug("Processor.send: sexp: "+sexp.toWire())
-   
     if self.sendFct == None:
       log.error("Processor.send: send function has not been set")
+      self.abortCalls(registered, "send function has not been set")
       return
 
-    data = sexp.toWire() + "\n"
-    size = "%06x" % (len(data))
-
-    self.sendFct(size + data)
-
+    try:
+      self.sendFct(frames)
+    except Exception as e:
+      log.error("Processor.send: unable to send calls: " + str(e))
+      self.abortCalls(registered, "unable to send: " + str(e))
+
+  # Split the incoming data into frames and feed each frame to an incremental
+  # parser as the chunks arrive: messages are queued already parsed.
+  # Chunks are consumed in place by moving a read position (no copy of the
+  # remaining data), parsed messages are kept in a deque.
+  # The head of each frame gives its kind:
+  # - when skipReturn(callId) is given and skippingReturns() is true, (:return ...)
+  #   frames are kept as text until complete: the callId ends the frame,
+  #   responses to skip (e.g. of superseded calls) are then dropped without
+  #   being parsed. Otherwise they are parsed as they arrive, like events,
+  # - when skipEvent(eventName) is true, the event is dropped without being parsed.
   class BufferMessage:
-    def __init__(self):
-      self.messages = []
-      self.rest = ''
+    HeadSize = 64   # an event name is expected within the first characters
+    reHead = re.compile(r'\((:[^ \t\r\n()"]*)[ \t\r\n()"]')
+    reReturnId = re.compile(r'(\d+)\)\s*$')
+
+    Undecided, Stream, Return, Skip = range(4)
+
+    def __init__(self, builder = None, skipReturn = None, skipEvent = None, skippingReturns = None):
+      self.messages = collections.deque()
+      self.parser = SExpStreamParser(builder)
+      self.skipReturn = skipReturn
+      self.skippingReturns = skippingReturns
+      self.skipEvent = skipEvent
+      self.header = ''
       self.expectedSize = 0
-
+      self.mode = self.Undecided
+      self.head = ''          # first characters of the frame, until its kind is known
+      self.pieces = []        # text of a (:return ...) frame
+      self.skipped = 0        # number of messages dropped unparsed
+      self.recorder = None    # SwankStats: frame sizes and parse times
+      self.frameSize = 0
+      self.parseTime = 0
+
+    # data: utf-8 encoded string (or unicode)
     def add(self, data):
 
-      def consume(data, size):
-        return data[size:]
+      # NOTE: the size given in the header is a number of characters, utf-8
+      # data is consumed character by character (see utf8Advance) and kept
+      # encoded: parsed strings are utf-8 encoded str.
+
+      pos = 0
+      size = len(data)
 
-      # NOTE: Be careful, len(data) may differ from expected size due to encoding (utf8, ascii).
-      # EnsimeClient provide a mode (RawAscii) which encode utf8 characters to xmlchar ascii.
-      # RawAscii should be used until utf8 is properly handled in vim (omni-completion...etc.)
-      # In case we receive utf8 characters here, we must: data = data.encode('utf-8')
+      while pos < size:
 
-      data = self.rest + data.replace("\n", '')
-      self.rest = ''
-      expect = self.expectedSize
+        if self.expectedSize == 0:
+          if self.header == '':
+            # frames may be separated by new lines (see EnsimeClient RawProxy)
+            while pos < size and data[pos] == "\n":
+              pos += 1
+            if pos == size:
+              break
 
-      keepGoing = True
-      while keepGoing:
+          need = 6 - len(self.header)
+          self.header += data[pos:pos+need]
+          pos += need
+          if len(self.header) < 6:
+            break
 
-        if expect == 0:
           try:
-            expect = int(data[:6], 16)
-            data = consume(data, 6)
+            self.expectedSize = int(self.header, 16)
+            self.frameSize = self.expectedSize
+            self.header = ''
           except Exception as e:
-            log.error("Buffer.add: exception (%s) expected header in hex but got: '%s'" % (e, data))
+            log.error("Buffer.add: exception (%s) expected header in hex but got: '%s'" % (e, self.header))
+            self.header = ''
             return False
 
-        dataSize = len(data)
+        (end, chars) = utf8Advance(data, pos, self.expectedSize, size)
+        self.expectedSize -= chars
+
+        if self.mode == self.Undecided:
+          take = min(end, pos + self.HeadSize - len(self.head))
+          self.head += data[pos:take]
+          pos = take
+          m = self.reHead.match(self.head)
+          if m == None and len(self.head) < self.HeadSize and self.expectedSize > 0:
+            continue
+          self.start(m)
+
+        if pos < end:
+          if self.mode == self.Stream:
+            self.parse(data, pos, end)
+          elif self.mode == self.Return:
+            self.pieces.append(data[pos:end])
+        pos = end
+
+        if self.expectedSize == 0:
+          self.end()
+
+    # the kind of the frame is known from its head
+    def start(self, m):
+      name = None
+      if m != None: name = m.group(1)
+
+      if name == ':return' and self.skipReturn != None and \
+         (self.skippingReturns == None or self.skippingReturns()):
+        self.mode = self.Return
+        self.pieces = [self.head]
+      elif name != None and name != ':return' and self.skipEvent != None and self.skipEvent(name):
+        self.mode = self.Skip
+        self.skipped += 1
+        if self.recorder != None: self.recorder.count('skipped ' + name)
+      else:
+        self.mode = self.Stream
+        self.parse(self.head)
+      self.head = ''
+
+    def end(self):
+      if self.mode == self.Return:
+        text = ''.join(self.pieces)
+        self.pieces = []
+        m = self.reReturnId.search(text, max(0, len(text) - 32))
+        if m != None and self.skipReturn(int(m.group(1))):
+          self.skipped += 1
+        else:
+          self.parse(text)
+
+      if self.mode != self.Skip:
+        self.parse(None)
+
+      if self.recorder != None:
+        self.recorder.add('frame size', self.frameSize)
+        if self.parseTime > 0:
+          self.recorder.add('parse', self.parseTime * 1000)
+        self.parseTime = 0
 
-        if dataSize == expect:
-          self.messages.append(data)
-          expect = 0
-          keepGoing = False
+      self.mode = self.Undecided
 
-        elif dataSize < expect:
-          self.rest = data
-          keepGoing = False
+    # feed the parser (data None: end of the frame), timed when recording stats
+    def parse(self, data, start = 0, end = None):
+      if self.recorder != None:
+        t = time.time()
 
-        elif dataSize > expect:
-          self.messages.append(data[:expect])
-          data = consume(data, expect)
-          expect = 0
+      if data == None:
+        self.messages.extend(self.parser.finish())
+      else:
+        self.messages.extend(self.parser.feed(data, start, end))
 
-      self.expectedSize = expect
+      if self.recorder != None:
+        self.parseTime += time.time() - t
 
     def has(self):
       if len(self.messages) > 0:
@@ -304,9 +804,4 @@ class SwankProcessor(object):
     def get(self):
       if len(self.messages) == 0:
         return None
-      self.messages.reverse()
-      e = self.messages.pop()
-      self.messages.reverse()
-      return e
-
-
+      return self.messages.popleft()
@@ -0,0 +1,119 @@
+# SwankStats.py
+#
+# Copyright 2012 Jeanluc Chasseriau <jeanluc@lo.cx>
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# SwankStats usage:
+#   SwankProcessor().enableStats(60) # dump to the log every minute
+#   ...
+#   stats = SwankProcessor().stats()
+#   stats['histograms']['rtt swank:completions']['p90'] # milliseconds
+#
+# Recorded by SwankProcessor:
+#   rtt <method>      milliseconds from send to the matching :return
+#   handler <method>  milliseconds spent in the response handler
+#   handler <event>   milliseconds spent in the event subscribers
+#   parse             milliseconds spent parsing and decoding a frame
+#   frame size        characters of a frame
+#   event <event>     events dispatched
+#   skipped <event>   events without subscriber, dropped unparsed
+
+import math
+import threading
+import logging
+
+# ensime-common should be initialized with LogSetup
+log = logging.getLogger('ensime-common')
+
+# Values counted in power of 2 buckets: a value v goes in the bucket b with
+# b/2 <= v < b, percentiles are given as bucket bounds.
+class Histogram(object):
+  def __init__(self):
+    self.count = 0
+    self.total = 0
+    self.min = None
+    self.max = None
+    self.buckets = {}   # exponent: count
+
+  def add(self, value):
+    self.count += 1
+    self.total += value
+    if self.min == None or value < self.min: self.min = value
+    if self.max == None or value > self.max: self.max = value
+
+    e = math.frexp(value)[1]
+    self.buckets[e] = self.buckets.get(e, 0) + 1
+
+  # upper bound of the values below the p quantile (p in [0, 1])
+  def percentile(self, p):
+    if self.count == 0: return None
+    left = p * self.count
+    for e in sorted(self.buckets.keys()):
+      left -= self.buckets[e]
+      if left <= 0:
+        break
+    return min(math.ldexp(1, e), self.max)
+
+  def mean(self):
+    if self.count == 0: return None
+    return float(self.total) / self.count
+
+  def asDict(self):
+    return {
+      'count': self.count,
+      'total': self.total,
+      'mean': self.mean(),
+      'min': self.min,
+      'max': self.max,
+      'p50': self.percentile(0.5),
+      'p90': self.percentile(0.9),
+      'p99': self.percentile(0.99),
+      'buckets': [(math.ldexp(1, e), self.buckets[e]) for e in sorted(self.buckets.keys())]
+    }
+
+# Histograms and counters by name
+class SwankStats(object):
+  def __init__(self):
+    self.histograms = {}  # name: Histogram
+    self.counters = {}    # name: count
+    self.lock = threading.Lock()
+
+  def add(self, name, value):
+    with self.lock:
+      histogram = self.histograms.get(name)
+      if histogram == None:
+        histogram = self.histograms[name] = Histogram()
+      histogram.add(value)
+
+  def count(self, name):
+    with self.lock:
+      self.counters[name] = self.counters.get(name, 0) + 1
+
+  def snapshot(self):
+    with self.lock:
+      return {
+        'histograms': dict((name, h.asDict()) for (name, h) in self.histograms.items()),
+        'counters': dict(self.counters)
+      }
+
+  def dump(self):
+    stats = self.snapshot()
+
+    for name in sorted(stats['histograms'].keys()):
+      h = stats['histograms'][name]
+      log.info("SwankStats: %s: count %d mean %.3f p50 %g p90 %g p99 %g max %g",
+               name, h['count'], h['mean'], h['p50'], h['p90'], h['p99'], h['max'])
+
+    for name in sorted(stats['counters'].keys()):
+      log.info("SwankStats: %s: %d", name, stats['counters'][name])
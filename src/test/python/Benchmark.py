@@ -0,0 +1,330 @@
+# Benchmark.py
+#
+# Copyright 2012 Jeanluc Chasseriau <jeanluc@lo.cx>
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmark of the S-Expression and framing layers on generated Swank traffic
+#
+# Usage (from this directory):
+#   python Benchmark.py [-o bench_output.json] [-c previous.json] [-r repeat] [-f filter]
+#
+# The traffic is generated from a fixed seed, each benchmark runs in its own
+# process (when fork is available). The reported peak memory is the growth of
+# the resident memory during the operation, traffic generation excluded.
+# Results are saved as JSON, -c compares them with a previous run.
+
+import os
+import sys
+import json
+import random
+import timeit
+import platform
+import resource
+import subprocess
+from optparse import OptionParser
+sys.path.append("../../main/python")
+from SwankProtocolHelper import *
+
+log = logging.getLogger('Benchmark')
+
+SEED = 42
+
+def frame(s):
+  return "%06x%s" % (utf8Length(s), s)
+
+def randomName(rnd, prefix = ''):
+  return prefix + ''.join(rnd.choice('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ') for i in range(rnd.randint(3, 12)))
+
+def randomType(rnd, depth):
+  if depth == 0 or rnd.random() < 0.3:
+    return '(:name "%s" :type-id %d :full-name "scala.collection.%s")' % (randomName(rnd), rnd.randint(1, 99999), randomName(rnd))
+  args = ' '.join(randomType(rnd, depth - 1) for i in range(rnd.randint(1, 2)))
+  return '(:name "%s" :type-id %d :type-args (%s))' % (randomName(rnd), rnd.randint(1, 99999), args)
+
+#
+# Generated traffic: each generator returns the list of messages
+#
+
+# (:return (:ok (:prefix "ge" :completions (...))) callId) with 10k completions
+def completions(rnd):
+  items = []
+  for i in range(10000):
+    items.append('(:name "%s" :type-sig "(%s, %s) => List[%s]" :type-id %d :is-callable %s)' % (
+      randomName(rnd, 'ge'), randomName(rnd), randomName(rnd), randomName(rnd), rnd.randint(1, 99999), rnd.choice(['t', 'nil'])))
+  return ['(:return (:ok (:prefix "ge" :completions (%s))) 42)' % ' '.join(items)]
+
+# (:scala-notes (:is-full t :notes (...))) with notes carrying deeply nested types
+def scalaNotes(rnd):
+  notes = []
+  for i in range(2000):
+    notes.append('(:severity %s :msg "type mismatch;\\n found   : %s\\n required: \\"%s\\"" :beg %d :end %d :line %d :col %d :file "/src/main/scala/%s.scala" :type %s)' % (
+      rnd.choice(['error', 'warn', 'info']), randomName(rnd), randomName(rnd), i * 10, i * 10 + 5, i, rnd.randint(1, 120), randomName(rnd), randomType(rnd, 12)))
+  return ['(:scala-notes (:is-full t :notes (%s)))' % ' '.join(notes)]
+
+# (:return (:ok ((:file ... :offset ... :start ... :end ...) ...)) callId) with 20k positions
+def usesOfSymbol(rnd):
+  uses = []
+  for i in range(20000):
+    start = rnd.randint(0, 100000)
+    uses.append('(:file "/src/main/scala/%s/%s.scala" :offset %d :start %d :end %d)' % (randomName(rnd), randomName(rnd), start, start, start + rnd.randint(1, 30)))
+  return ['(:return (:ok (%s)) 43)' % ' '.join(uses)]
+
+# burst of 20k small events
+def eventBurst(rnd):
+  events = []
+  for i in range(20000):
+    kind = rnd.random()
+    if kind < 0.6:
+      events.append(u'(:background-message 105 "Indexing %s.scala \u2192 %d%%")' % (randomName(rnd), rnd.randint(0, 100)))
+    elif kind < 0.9:
+      events.append('(:clear-all-scala-notes)')
+    else:
+      events.append('(:full-typecheck-finished)')
+  return [e.encode('utf-8') for e in events]
+
+TRAFFIC = [
+  ('completions', completions),
+  ('scala-notes', scalaNotes),
+  ('uses-of-symbol', usesOfSymbol),
+  ('event-burst', eventBurst)
+]
+
+#
+# Operations: op(messages, prepared) where prepared = prepare(messages)
+#
+
+# decode a message like SwankProcessor does (see SwankMessageBuilder)
+def decode(m):
+  parser = SExpStreamParser(SwankMessageBuilder())
+  forms = parser.feed(m)
+  forms.extend(parser.finish())
+  return forms[0]
+
+def itemToPy(item):
+  if isinstance(item, SExpList): return item.toPy()
+  return item.toValue()
+
+# same envelope as SwankMessageBuilder: only the values are converted
+def treeToPy(tree):
+  items = tree.toItems()
+  if items[0].toValue() == ':return':
+    result = items[1].toItems()
+    return [':return', [result[0].toValue()] + [itemToPy(item) for item in result[1:]], items[2].toValue()]
+  return [items[0].toValue()] + [itemToPy(item) for item in items[1:]]
+
+def parse(messages, prepared):
+  for m in messages:
+    SExpParser().parse(m)
+
+def toPy(messages, trees):
+  for tree in trees:
+    treeToPy(tree)
+
+def decodeMessages(messages, prepared):
+  for m in messages:
+    decode(m)
+
+def pyToSExpToWire(messages, pys):
+  converter = SExpConverter()
+  for py in pys:
+    converter.pyToSExp(py).toWire()
+
+def pyToWire(messages, pys):
+  converter = SExpConverter()
+  for py in pys:
+    converter.pyToWire(py)
+
+BUFFER_CHUNK = 64 * 1024
+
+def bufferMessage(messages, data):
+  # same callbacks as SwankProcessor: no call is forgotten, every event is subscribed
+  buf = SwankProcessor().BufferMessage(SwankMessageBuilder(), lambda callId: False,
+                                       lambda eventName: False, lambda: False)
+  for i in range(0, len(data), BUFFER_CHUNK):
+    buf.add(data[i:i+BUFFER_CHUNK])
+  count = 0
+  while buf.get() != None:
+    count += 1
+  if count != len(messages):
+    raise Exception("BufferMessage: %d messages instead of %d" % (count, len(messages)))
+
+OPERATIONS = [
+  ('SExpParser.parse', parse, None),
+  ('SExpList.toPy', toPy, lambda messages: [SExpParser().parse(m) for m in messages]),
+  ('SwankMessageBuilder', decodeMessages, None),
+  ('SExpConverter.pyToSExp+toWire', pyToSExpToWire, lambda messages: [decode(m) for m in messages]),
+  ('SExpConverter.pyToWire', pyToWire, lambda messages: [decode(m) for m in messages]),
+  ('BufferMessage.add+get', bufferMessage, lambda messages: ''.join(frame(m) for m in messages))
+]
+
+# VmRSS or VmHWM of /proc/self/status in kilobytes, None without /proc
+def procMemory(name):
+  try:
+    f = open('/proc/self/status')
+    try:
+      for line in f:
+        if line.startswith(name + ':'):
+          return int(line.split()[1])
+    finally:
+      f.close()
+  except (IOError, OSError):
+    pass
+  return None
+
+# peak resident memory of the process, in kilobytes
+def peakMemory():
+  rss = procMemory('VmHWM')
+  if rss != None: return rss
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform == 'darwin': rss /= 1024
+  return rss
+
+# start a new peak at the current resident memory (linux only), returns the
+# memory the peak is measured from
+def resetPeakMemory():
+  try:
+    f = open('/proc/self/clear_refs', 'w')
+    f.write('5')
+    f.close()
+  except (IOError, OSError):
+    return peakMemory()
+  return procMemory('VmRSS')
+
+def benchmark(trafficName, generator, opName, op, prepare, repeat):
+  messages = generator(random.Random(SEED))
+  prepared = None
+  if prepare != None:
+    prepared = prepare(messages)
+
+  memoryBefore = resetPeakMemory()
+  times = []
+  for i in range(repeat):
+    start = timeit.default_timer()
+    op(messages, prepared)
+    times.append(timeit.default_timer() - start)
+
+  size = sum(len(m) for m in messages)
+  best = min(times)
+  return {
+    'traffic': trafficName,
+    'operation': opName,
+    'messages': len(messages),
+    'bytes': size,
+    'best': best,
+    'times': times,
+    'MBps': size / best / 1e6,
+    'msgps': len(messages) / best,
+    'peakMemoryKB': peakMemory() - memoryBefore,
+    'processPeakMemoryKB': peakMemory()
+  }
+
+# run fct() in a child process when possible: each benchmark gets its own peak memory
+def isolated(fct):
+  if not hasattr(os, 'fork'):
+    return fct()
+
+  (r, w) = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(r)
+    try:
+      out = json.dumps(fct())
+    except Exception as e:
+      out = json.dumps({'error': str(e)})
+    f = os.fdopen(w, 'w')
+    f.write(out)
+    f.close()
+    os._exit(0)
+
+  os.close(w)
+  chunks = []
+  while True:
+    data = os.read(r, 65536)
+    if data == '': break
+    chunks.append(data)
+  os.close(r)
+  os.waitpid(pid, 0)
+  return json.loads(''.join(chunks))
+
+def gitCommit():
+  try:
+    return subprocess.Popen(['git', 'rev-parse', 'HEAD'], stdout = subprocess.PIPE,
+                            stderr = subprocess.PIPE).communicate()[0].strip()
+  except Exception:
+    return None
+
+def report(results, previous = None):
+  before = {}
+  if previous != None:
+    for r in previous['results']:
+      before[(r['traffic'], r['operation'])] = r
+
+  print("%-16s %-30s %10s %12s %10s %10s" % ('traffic', 'operation', 'MB/s', 'msgs/s', 'peak +MB', 'vs prev'))
+  for r in results:
+    if r.has_key('error'):
+      print("%-16s %-30s error: %s" % (r['traffic'], r['operation'], r['error']))
+      continue
+    old = before.get((r['traffic'], r['operation']))
+    change = ''
+    if old != None and not old.has_key('error'):
+      change = "%+.1f%%" % ((old['best'] / r['best'] - 1) * 100)
+    print("%-16s %-30s %10.2f %12.0f %10.1f %10s" % (r['traffic'], r['operation'], r['MBps'], r['msgps'], r['peakMemoryKB'] / 1024.0, change))
+
+def main():
+  parser = OptionParser()
+  parser.add_option('-o', '--output', dest='output', default='bench_output.json',
+                    help='JSON file to save the results to (default: bench_output.json)')
+  parser.add_option('-c', '--compare', dest='compare',
+                    help='JSON results of a previous run to compare with')
+  parser.add_option('-r', '--repeat', dest='repeat', type='int', default=5,
+                    help='runs of each benchmark, the best one is reported (default: 5)')
+  parser.add_option('-f', '--filter', dest='filter', default='',
+                    help='only run the benchmarks whose traffic or operation name contains this')
+  (options, args) = parser.parse_args()
+
+  results = []
+  for (trafficName, generator) in TRAFFIC:
+    for (opName, op, prepare) in OPERATIONS:
+      if options.filter not in trafficName and options.filter not in opName:
+        continue
+      result = isolated(lambda: benchmark(trafficName, generator, opName, op, prepare, options.repeat))
+      result.setdefault('traffic', trafficName)
+      result.setdefault('operation', opName)
+      results.append(result)
+
+  previous = None
+  if options.compare != None:
+    f = open(options.compare)
+    previous = json.load(f)
+    f.close()
+
+  report(results, previous)
+
+  output = {
+    'commit': gitCommit(),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'seed': SEED,
+    'repeat': options.repeat,
+    'results': results
+  }
+  f = open(options.output, 'w')
+  json.dump(output, f, indent = 2, sort_keys = True)
+  f.close()
+  print("results saved to " + options.output)
+  return 0
+
+if __name__ == '__main__':
+  ret = main()
+  sys.exit(ret)
@@ -0,0 +1,183 @@
+# TestEnsimeClient.py
+#
+# Copyright 2012 Jeanluc Chasseriau <jeanluc@lo.cx>
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+sys.path.append("../../../bin")
+from EnsimeClient import *
+
+log = logging.getLogger('TestEnsimeClient')
+
+def frame(s):
+  return "%06x%s" % (len(s.decode('utf-8')), s)
+
+def testReadFrames():
+  msgs = [u'(:background-message 105 "caf\xe9 \u2192 \U0001d54a")'.encode('utf-8'), '(:compiler-ready)']
+  data = ''.join(frame(m) for m in msgs)
+  expected = [(len(m.decode('utf-8')), frame(m)[:6], m) for m in msgs]
+
+  for cut in range(len(data) + 1):
+    read = Proxy.Read(None)
+    got = read.frames(data[:cut]) + read.frames(data[cut:])
+    if got != expected or read.closed:
+      print("testReadFrames: failed at %d: %s" % (cut, got))
+      return False
+
+  # invalid header: the frames completed before are kept
+  read = Proxy.Read(None)
+  if read.frames(data + 'xyz123(') != expected or not read.closed:
+    print("testReadFrames: failed - invalid header")
+    return False
+
+  return True
+
+def testReadServerClosed():
+  (client, server) = socket.socketpair()
+  data = frame('(:compiler-ready)') + frame('(:indexer-ready)')
+  server.sendall(data)
+  server.close()
+
+  # the first read fills the buffer, the second one gets the end of the connection
+  read = Proxy.Read(client)
+  read.buf = bytearray(len(data))
+  read.view = memoryview(read.buf)
+  frames = read.server()
+  client.close()
+
+  if [f[2] for f in frames] != ['(:compiler-ready)', '(:indexer-ready)'] or not read.closed:
+    print("testReadServerClosed: failed - %s %s" % (frames, read.closed))
+    return False
+
+  return True
+
+def testReadStdin():
+  (r, w) = os.pipe()
+  read = Proxy.Read(None)
+  read.stdinFd = r
+
+  os.write(w, 'line 1\nline')
+  first = read.stdin()
+  os.write(w, ' 2\n')
+  second = read.stdin()
+  os.close(w)
+  last = read.stdin()
+  os.close(r)
+
+  if first != ['line 1\n'] or second != ['line 2\n'] or last != None:
+    print("testReadStdin: failed - %s %s %s" % (first, second, last))
+    return False
+
+  return True
+
+def testWriteStdout():
+  (r, w) = os.pipe()
+  write = Proxy.Write(None)
+  write.stdoutFd = w
+  write.maxLatency = 10
+
+  # events may be held up to maxLatency, replies are not
+  write.stdout('(:compiler-ready)\n', False)
+  held = write.stdoutTimeout()
+  write.stdout('(:return (:ok t) 42)\n')
+  due = write.stdoutTimeout()
+
+  if not 9 < held <= 10 or due != 0 or write.stdoutBlocked():
+    print("testWriteStdout: failed - timeouts %s %s" % (held, due))
+    return False
+
+  # one write for everything pending
+  write.flushStdout()
+  data = os.read(r, 4096)
+  os.close(r)
+  os.close(w)
+
+  if data != '(:compiler-ready)\n(:return (:ok t) 42)\n' or write.stdoutTimeout() != None:
+    print("testWriteStdout: failed - %s" % data)
+    return False
+
+  return True
+
+def testWriteDrain():
+  (r, w) = os.pipe()
+  (client, server) = socket.socketpair()
+  write = Proxy.Write(client)
+  write.stdoutFd = w
+  write.maxLatency = 10
+
+  # held events and the rest of a partial write are written when exiting
+  write.stdout('(:compiler-ready)\n', False)
+  write.toServer.append('000011(:swank-rpc)')
+  if not write.drain():
+    print("testWriteDrain: failed - drain")
+    return False
+
+  data = os.read(r, 4096)
+  sent = server.recv(4096)
+  for fd in (r, w): os.close(fd)
+  client.close()
+  server.close()
+
+  if data != '(:compiler-ready)\n' or sent != '000011(:swank-rpc)':
+    print("testWriteDrain: failed - %s %s" % (data, sent))
+    return False
+
+  return True
+
+# stdin and stdout sharing their flags (e.g. a tty) are left blocking on exit
+def testRunProxyFlags():
+  (terminal, other) = socket.socketpair()
+  (client, server) = socket.socketpair()
+  server.close()
+
+  class Fd(object):
+    def fileno(self): return terminal.fileno()
+
+  (stdin, stdout) = (sys.stdin, sys.stdout)
+  sys.stdin = sys.stdout = Fd()
+  try:
+    runProxy(RawProxy(client))
+  finally:
+    (sys.stdin, sys.stdout) = (stdin, stdout)
+
+  flags = fcntl.fcntl(terminal.fileno(), fcntl.F_GETFL)
+  for s in (terminal, other, client): s.close()
+
+  if flags & os.O_NONBLOCK:
+    print("testRunProxyFlags: failed - descriptor left non-blocking")
+    return False
+
+  return True
+
+testThemAll = [
+  testReadFrames,
+  testReadServerClosed,
+  testReadStdin,
+  testWriteStdout,
+  testWriteDrain,
+  testRunProxyFlags
+]
+
+def main():
+  for testFct in testThemAll:
+    if not testFct():
+      print("Test function failed")
+      return 1
+
+  print("All tests passed")
+  return 0
+
+if __name__ == '__main__':
+  ret = main()
+  sys.exit(ret)
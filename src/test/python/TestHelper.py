@@ -36,9 +36,93 @@ def testFindLastDist():
 
   return True
 
+def testUtf8Advance():
+  data = u'a\xe9\u2192\U0001d54ab'.encode('utf-8')
+
+  if utf8Length(data) != 5 or utf8Length('ascii') != 5:
+    print("testUtf8Advance: failed - utf8Length")
+    return False
+
+  if utf8Advance(data, 0, 3) != (6, 3) or utf8Advance(data, 0, 10) != (len(data), 5):
+    print("testUtf8Advance: failed - utf8Advance")
+    return False
+
+  # stop in the middle of a character
+  if utf8Advance(data, 0, 3, 4) != (4, 3) or utf8Missing(data[:4]) != 2 or utf8Missing(data) != 0:
+    print("testUtf8Advance: failed - split character")
+    return False
+
+  return True
+
+def testLruCache():
+  cache = LruCache(2)
+  cache.put('a', 1)
+  cache.put('b', 2)
+  cache.get('a')
+  cache.put('c', 3)
+
+  if cache.get('b') != None or cache.get('a') != 1 or cache.get('c') != 3:
+    print("testLruCache: failed - eviction")
+    return False
+
+  cache.removeIf(lambda key: key == 'a')
+  if len(cache) != 1 or cache.stats() != {'hits': 3, 'misses': 1, 'size': 1}:
+    print("testLruCache: failed - %s" % cache.stats())
+    return False
+
+  return True
+
+def testLogSetup():
+  LogSetup().initLogger('TestHelper')
+  trace = traceLogger('TestHelper', 'test')
+
+  if log.isEnabledFor(logging.DEBUG) or trace.isEnabledFor(logging.DEBUG):
+    print("testLogSetup: failed - debug enabled by default")
+    return False
+
+  LogSetup().setTrace('TestHelper', 'test')
+  if log.isEnabledFor(logging.DEBUG) or not trace.isEnabledFor(logging.DEBUG):
+    print("testLogSetup: failed - trace not enabled")
+    return False
+
+  LogSetup().setLevel('TestHelper', logging.DEBUG)
+  LogSetup().setTrace('TestHelper', 'test', False)
+  if not log.isEnabledFor(logging.DEBUG) or trace.isEnabledFor(logging.DEBUG):
+    print("testLogSetup: failed - trace not disabled")
+    return False
+
+  return True
+
+def testCatchAndLogException():
+  records = []
+
+  class Handler(logging.Handler):
+    def emit(self, record):
+      records.append(record)
+
+  LogSetup().initLogger('TestHelper')
+  LogSetup().addHandler('TestHelper', 'testHandler', Handler)
+
+  @CatchAndLogException
+  def divide(a, b):
+    return a / b
+
+  result = (divide(4, 2), divide(1, 0))
+  LogSetup().removeHandler('TestHelper', 'testHandler')
+
+  if result != (2, None) or len(records) != 1 or records[0].exc_info[0] != ZeroDivisionError:
+    print("testCatchAndLogException: failed - %s %s" % (result, records))
+    return False
+
+  return True
+
 
 testThemAll = [
-  testFindLastDist
+  testFindLastDist,
+  testUtf8Advance,
+  testLruCache,
+  testLogSetup,
+  testCatchAndLogException
 ]
 
 def main():
@@ -0,0 +1,337 @@
+# TestSExpression.py
+#
+# Copyright 2012 Jeanluc Chasseriau <jeanluc@lo.cx>
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+sys.path.append("../../main/python")
+from SExpression import *
+
+log = logging.getLogger('TestSExpression')
+
+def testParse():
+  s = '(:return (:ok (:name "foo" :type-id 12 :is-callable t :args nil)) 42)'
+  sexp = SExpParser().parse(s)
+
+  if sexp.toWire() != s:
+    print("testParse: failed - "+sexp.toWire())
+    return False
+
+  items = sexp.toItems()
+  if items[2].toValue() != 42 or not isinstance(items[1], SExpList):
+    print("testParse: failed - wrong items")
+    return False
+
+  return True
+
+def testParseNested():
+  depth = 500
+  s = '(' * depth + '1' + ')' * depth
+  sexp = SExpParser().parse(s)
+
+  for i in range(depth - 1):
+    sexp = sexp.toItems()[0]
+
+  if sexp.toItems()[0].toValue() != 1:
+    print("testParseNested: failed")
+    return False
+
+  return True
+
+def testParseEscapedQuote():
+  s = '(:text "say \\"(hello)\\"" :n 1)'
+  items = SExpParser().parse(s).toItems()
+
+  if len(items) != 4 or items[3].toValue() != 1:
+    print("testParseEscapedQuote: failed - "+str(len(items)))
+    return False
+
+  return True
+
+def testParseUnbalanced():
+  for s in ['(:a (1 2)', '(:a "foo)', '(:a 1))']:
+    sexp = SExpParser().parse(s)
+    if len(sexp.toItems()) != 0:
+      print("testParseUnbalanced: failed - "+s)
+      return False
+
+  return True
+
+def testStreamParser():
+  s = '(:name "a \\"quoted\\" (string)" :n 1234 :l (1 2 (3)))(:second t)'
+
+  # every possible split point, including inside the string escape
+  for cut in range(1, len(s)):
+    parser = SExpStreamParser()
+    forms = parser.feed(s[:cut])
+    forms.extend(parser.feed(s[cut:]))
+    forms.extend(parser.finish())
+
+    if len(forms) != 2 or forms[0].toWire() != SExpParser().parse(s).toWire():
+      print("testStreamParser: failed at %d" % cut)
+      return False
+
+  return True
+
+def testStreamParserPending():
+  parser = SExpStreamParser()
+
+  if parser.feed('(:a (1 2') != [] or not parser.pending():
+    print("testStreamParserPending: failed - form should be pending")
+    return False
+
+  forms = parser.feed(') 3)')
+  if len(forms) != 1 or parser.pending():
+    print("testStreamParserPending: failed - form should be complete")
+    return False
+
+  return True
+
+def testToPyRecord():
+  s = '(:name "foo" :type-id 12 :decl-pos (:file "a.scala" :offset 3) :args (1 2))'
+  obj = SExpParser().parse(s).toPy()
+
+  if obj.name != "foo" or obj.type_id != 12 or obj.decl_pos.offset != 3 or obj.args != [1, 2]:
+    print("testToPyRecord: failed - wrong attributes")
+    return False
+
+  if not obj.has('decl_pos') or obj.has('is_callable'):
+    print("testToPyRecord: failed - has()")
+    return False
+
+  if SExpConverter().pyToSExp(obj).toWire() != '(:args (1 2) :decl-pos (:file "a.scala" :offset 3) :name "foo" :type-id 12)':
+    print("testToPyRecord: failed - back to SExp")
+    return False
+
+  return True
+
+def testRecordShapes():
+  shapes = SExpPyRecordShapes()
+  shapes.clear()
+
+  s = '((:name "a" :type-id 1) (:name "b" :type-id 2) (:file "c" :offset 3))'
+  objs = SExpParser().parse(s).toPy()
+
+  if shapes.stats() != {'hits': 1, 'misses': 2, 'shapes': 2}:
+    print("testRecordShapes: failed - "+str(shapes.stats()))
+    return False
+
+  if type(objs[0]) is not type(objs[1]) or objs[1].name != "b" or objs[2].offset != 3:
+    print("testRecordShapes: failed - records")
+    return False
+
+  if shapes.shapes()[0] != ((':name', ':type-id'), 2):
+    print("testRecordShapes: failed - "+str(shapes.shapes()))
+    return False
+
+  return True
+
+def testParsePy():
+  s = '(1 "two" nil t ((:name "a" :type-id 1) (:name "b" :type-id 2)) (:f (:g 4)))'
+  py = SExpParser().parsePy(s)
+  tree = SExpParser().parse(s).toValue()
+
+  if py != tree or py[5].f.g != 4:
+    print("testParsePy: failed - "+str(py))
+    return False
+
+  if py[4][0]._names != ('name', 'type_id') or py[5]._names != ('f',) or py[5].f._names != ('g',):
+    print("testParsePy: failed - field names")
+    return False
+
+  return True
+
+def testRecordEquality():
+  line = SExpParser().parsePy('(:line 3)')
+  col = SExpParser().parsePy('(:col 3)')
+
+  if line == col or not line != col or line == (3,) or line != SExpParser().parsePy('(:line 3)'):
+    print("testRecordEquality: failed - equality")
+    return False
+
+  if hash(line) == hash(col) or hash(line) != hash(SExpParser().parsePy('(:line 3)')):
+    print("testRecordEquality: failed - hash")
+    return False
+
+  empty = SExpPyRecordShapes().recordClass(())(())
+  if not line.has('line') or line.has('count') or line.has('index') or not empty:
+    print("testRecordEquality: failed - has() or truth")
+    return False
+
+  return True
+
+def testRecordRepr():
+  record = SExpParser().parsePy('(:name "foo" :type-id 12 :args ((:name "x")))')
+  expected = "SExpPyRecord(name='foo', type_id=12, args=[SExpPyRecord(name='x')])"
+
+  if repr(record) != expected or str(record) != expected:
+    print("testRecordRepr: failed - "+repr(record))
+    return False
+
+  # records are read-only
+  try:
+    record.name = 'bar'
+    print("testRecordRepr: failed - attribute assignment")
+    return False
+  except AttributeError:
+    pass
+
+  return True
+
+def testParseLazy():
+  notes = ' '.join('(:msg "n (%d)" :pos (%d %d))' % (i, i, i) for i in range(1000))
+  s = '(:ok (:is-full t :notes (%s)) "end")' % notes
+  sexp = SExpParser().parseLazy(s)
+
+  if sexp[0].toValue() != ':ok' or sexp.pos > 5:
+    print("testParseLazy: failed - first item")
+    return False
+
+  if len(sexp) != 3 or sexp[2].toValue() != "end":
+    print("testParseLazy: failed - length")
+    return False
+
+  # body not parsed yet
+  body = sexp[1]
+  if len(body.children) != 0:
+    print("testParseLazy: failed - body already parsed")
+    return False
+
+  if len(body[3]) != 1000 or body[3][999][1].toValue() != "n (999)":
+    print("testParseLazy: failed - notes")
+    return False
+
+  if sexp.toWire() != s or body.toPy().notes[10].pos != [10, 10]:
+    print("testParseLazy: failed - toWire/toPy")
+    return False
+
+  if SExpParser().parse(s).toValue() != SExpParser().parseLazy(s).toValue():
+    print("testParseLazy: failed - toValue")
+    return False
+
+  return True
+
+def testPyToWire():
+  converter = SExpConverter()
+  record = SExpParser().parsePy('(:file "a.scala" :offset 12)')
+  py = [':swank-rpc', ['swank:completions', 'a.scala', 12, 0, False, True, record, [], {'a_b': 'c'}], 42]
+
+  wire = converter.pyToWire(py)
+  if wire != converter.pyToSExp(py).toWire():
+    print("testPyToWire: failed - "+wire)
+    return False
+
+  frame = converter.pyToFrame(py)
+  if frame != "%06x%s\n" % (len(wire) + 1, wire):
+    print("testPyToWire: failed - "+frame)
+    return False
+
+  frame = converter.pyToFrame(['swank:completions', u'caf\xe9.scala'])
+  if frame != '000021(swank:completions "caf\xc3\xa9.scala")\n':
+    print("testPyToWire: failed - "+frame)
+    return False
+
+  if converter.pyToWire([1, converter.pyToWire, 2]) != '(1 2)':
+    print("testPyToWire: failed - skipped item")
+    return False
+
+  return True
+
+def testStringEscape():
+  value = 'C:\\src\\"quoted" (paren) \'single\' \\'
+  wire = SExpConverter().pyToWire(['swank:format-source', value])
+
+  if wire != '(swank:format-source "C:\\\\src\\\\\\"quoted\\" (paren) \'single\' \\\\")':
+    print("testStringEscape: failed - "+wire)
+    return False
+
+  if StringAtom(value).toWire() != wire[21:-1]:
+    print("testStringEscape: failed - StringAtom.toWire")
+    return False
+
+  if SExpParser().parse(wire).toItems()[1].toValue() != value or SExpParser().parsePy(wire)[1] != value:
+    print("testStringEscape: failed - round trip")
+    return False
+
+  return True
+
+# atoms are classified on their first character: ':' keyword, '-' or digit int
+# when int() accepts it, nil, t, anything else a string
+def testTokenClassification():
+  converter = SExpConverter()
+  tokens = [
+    (':name', KeywordAtom, SExpPyKeyword, ':name'),
+    (':decl-pos', KeywordAtom, SExpPyKeyword, ':decl-pos'),
+    (':scala.Int', KeywordAtom, SExpPyKeyword, ':scala.Int'),
+    ('12', IntAtom, int, 12),
+    ('-12', IntAtom, int, -12),
+    ('0', IntAtom, int, 0),
+    ('-', StringAtom, str, '-'),
+    ('12abc', StringAtom, str, '12abc'),
+    ('-x', StringAtom, str, '-x'),
+    ('nil', NilAtom, bool, False),
+    ('t', TruthAtom, bool, True),
+    ('nils', StringAtom, str, 'nils'),
+    ('"a\\"b"', StringAtom, str, 'a"b'),
+    ('"12"', StringAtom, str, '12'),
+    ('swank:foo', StringAtom, str, 'swank:foo')
+  ]
+
+  for (token, sexpType, pyType, value) in tokens:
+    sexp = converter.tokenToSExp(token)
+    if type(sexp) != sexpType or sexp.toValue() != value:
+      print("testTokenClassification: failed - tokenToSExp "+token+" - "+sexp.debugString())
+      return False
+
+    py = converter.tokenToPy(token)
+    if type(py) != pyType or py != value:
+      print("testTokenClassification: failed - tokenToPy "+token+" - "+repr(py))
+      return False
+
+  if converter.wireToPy(' -12 ') != -12 or converter.wireToSExp(' :ok ').toWire() != ':ok':
+    print("testTokenClassification: failed - surrounding blanks")
+    return False
+
+  return True
+
+testThemAll = [
+  testParse,
+  testParseNested,
+  testParseEscapedQuote,
+  testParseUnbalanced,
+  testStreamParser,
+  testStreamParserPending,
+  testToPyRecord,
+  testRecordShapes,
+  testParsePy,
+  testRecordEquality,
+  testRecordRepr,
+  testParseLazy,
+  testPyToWire,
+  testStringEscape,
+  testTokenClassification
+]
+
+def main():
+  for testFct in testThemAll:
+    if not testFct():
+      print("Test function failed")
+      return 1
+
+  print("All tests passed")
+  return 0
+
+if __name__ == '__main__':
+  ret = main()
+  sys.exit(ret)
@@ -0,0 +1,120 @@
+# TestSwankCache.py
+#
+# Copyright 2012 Jeanluc Chasseriau <jeanluc@lo.cx>
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+sys.path.append("../../main/python")
+from SwankCache import *
+
+log = logging.getLogger('TestSwankCache')
+
+def frame(s):
+  return "%06x%s" % (len(s), s)
+
+# send function answering the calls with responses[method](args)
+def answer(responses, sent):
+  def send(data):
+    call = SExpParser().parse(data[6:])
+    args = [arg.toValue() for arg in call[1]]
+    sent.append(args)
+    reply = '(:return (:ok %s) %d)' % (responses[args[0]](*args[1:]), call[2].toValue())
+    SwankProcessor().process(frame(reply))
+  return send
+
+def testCompletionCache():
+  names = ['bar', 'baz', 'Bar2', 'bat', 'foo']
+
+  def completions(filename, offset, limit, case):
+    prefix = 'foo.bar'[4:offset - 6]
+    found = [n for n in names if n.lower().startswith(prefix)][:limit]
+    return '(:prefix "%s" :completions (%s))' % (prefix, ' '.join('(:name "%s")' % n for n in found))
+
+  sent = []
+  SwankProcessor().setSendFunction(answer({'swank:completions': completions}, sent))
+  cache = SwankCompletionCache()
+
+  first = cache.completions('a.scala', 10, 'ba', 1, 10, False)().result(0)
+  narrowed = cache.completions('a.scala', 10, 'bar', 1, 10, False)().result(0)
+
+  if len(sent) != 1 or [c.name for c in first.completions] != ['bar', 'baz', 'Bar2', 'bat']:
+    print("testCompletionCache: failed - first: %s" % sent)
+    return False
+
+  if narrowed.prefix != 'bar' or [c.name for c in narrowed.completions] != ['bar', 'Bar2']:
+    print("testCompletionCache: failed - narrowed: %s" % narrowed.completions)
+    return False
+
+  # shorter prefix, new file version, truncated list and edits go to the server
+  cache.completions('a.scala', 10, 'b', 1, 10, False)()
+  cache.completions('a.scala', 10, 'bar', 2, 10, False)()
+  cache.completions('a.scala', 10, 'ba', 3, 2, False)()
+  cache.completions('a.scala', 10, 'bar', 3, 2, False)()
+  cache.invalidate('a.scala')
+  cache.completions('a.scala', 10, 'bar', 2, 10, False)()
+
+  if len(sent) != 6 or cache.stats() != {'hits': 1, 'misses': 6, 'size': 1}:
+    print("testCompletionCache: failed - %s %s" % (len(sent), cache.stats()))
+    return False
+
+  return True
+
+def testSymbolCache():
+  def symbolAtPoint(filename, offset):
+    return '(:name "sym%d")' % offset
+
+  sent = []
+  SwankProcessor().setSendFunction(answer({'swank:symbol-at-point': symbolAtPoint,
+                                           'swank:uses-of-symbol-at-point': lambda f, o: '()',
+                                           'swank:typecheck-file': lambda f: 't'}, sent))
+  cache = SwankSymbolCache()
+
+  # same identifier: served from the cache
+  names = [cache.symbolAtPoint('a.scala', offset, (10, 14), 1)().result(0).name for offset in (10, 12, 13)]
+  uses = cache.usesOfSymbolAtPoint('a.scala', 12, (10, 14), 1)().result(0)
+  if names != ['sym10'] * 3 or uses != [] or len(sent) != 2:
+    print("testSymbolCache: failed - %s %s" % (names, sent))
+    return False
+
+  # other identifier, file version and typecheck go to the server
+  cache.symbolAtPoint('a.scala', 20, (20, 22), 1)()
+  cache.symbolAtPoint('a.scala', 12, (10, 14), 2)()
+  typecheckFile('a.scala')().result(0)
+  cache.symbolAtPoint('a.scala', 12, (10, 14), 2)()
+  SwankProcessor().process(frame('(:clear-all-scala-notes)'))
+  cache.symbolAtPoint('a.scala', 12, (10, 14), 2)()
+
+  if len(sent) != 7 or cache.stats() != {'hits': 2, 'misses': 6, 'size': 1}:
+    print("testSymbolCache: failed - %s %s" % (len(sent), cache.stats()))
+    return False
+
+  return True
+
+testThemAll = [
+  testCompletionCache,
+  testSymbolCache
+]
+
+def main():
+  for testFct in testThemAll:
+    if not testFct():
+      print("Test function failed")
+      return 1
+
+  print("All tests passed")
+  return 0
+
+if __name__ == '__main__':
+  ret = main()
+  sys.exit(ret)
@@ -0,0 +1,437 @@
+# TestSwankProtocolHelper.py
+#
+# Copyright 2012 Jeanluc Chasseriau <jeanluc@lo.cx>
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import time
+import socket
+sys.path.append("../../main/python")
+from SwankProtocolHelper import *
+from SwankConnection import *
+
+log = logging.getLogger('TestSwankProtocolHelper')
+
+def frame(s):
+  return "%06x%s" % (len(s), s)
+
+def testBufferMessageChunks():
+  msgs = ['(:return (:ok (:pid nil :version "0.9")) 42)', '(:compiler-ready)', '(:indexer-ready)',
+          '(:background-message 105 "line 1\nline 2")']
+  data = ''.join(frame(m) + "\n" for m in msgs)
+
+  for chunkSize in [1, 5, 7, 64, len(data)]:
+    buf = SwankProcessor().BufferMessage()
+    for i in range(0, len(data), chunkSize):
+      buf.add(data[i:i+chunkSize])
+
+    got = []
+    while buf.has():
+      got.append(buf.get().toWire())
+
+    if got != msgs:
+      print("testBufferMessageChunks: failed with chunk size %d: %s" % (chunkSize, got))
+      return False
+
+  return True
+
+def testBufferMessageUtf8():
+  msg = u'(:background-message 105 "caf\xe9 \u2192 \U0001d54a")'
+  data = ("%06x" % len(msg)) + msg.encode('utf-8') + frame('(:compiler-ready)')
+
+  for cut in range(1, len(data)):
+    buf = SwankProcessor().BufferMessage(SwankMessageBuilder())
+    buf.add(data[:cut])
+    buf.add(data[cut:])
+
+    got = [buf.get(), buf.get()]
+    if got[0][2].decode('utf-8') != msg[26:-2] or got[1] != [':compiler-ready']:
+      print("testBufferMessageUtf8: failed at %d: %s" % (cut, got))
+      return False
+
+  return True
+
+def testProcess():
+  sent = []
+  responses = []
+  events = []
+
+  class Handler(SwankCallHandler):
+    def response(self, response):
+      responses.append(response)
+
+  processor = SwankProcessor()
+  processor.setSendFunction(sent.append)
+  processor.registerEvent(KeywordAtom('test-event'), lambda *args: events.append(args))
+
+  call = SwankCall()
+  call.setCaller(':swank-rpc')
+  call.setMethod('swank:symbol-at-point')
+  call.setArgs(['a.scala', 12])
+  call.setHandler(Handler())
+  call.send()
+
+  reply = '(:return (:ok (:name "foo" :type (:name "Int" :type-id 3))) %d)' % call.callId
+  processor.process(frame(reply) + frame('(:test-event 1 (2 3) (:a "b"))'))
+
+  if len(sent) != 1 or len(responses) != 1 or responses[0].type.name != "Int":
+    print("testProcess: failed - response: %s" % responses)
+    return False
+
+  if len(events) != 1 or events[0][0] != 1 or events[0][1] != [2, 3] or events[0][2].a != "b":
+    print("testProcess: failed - event: %s" % events)
+    return False
+
+  if call.callId in processor.callHandler:
+    print("testProcess: failed - call still registered")
+    return False
+
+  return True
+
+@SwankCaller("swank-rpc")
+class TestRpc:
+  @SwankMethod("swank:symbol-at-point")
+  def symbolAtPoint(filename, offset): pass
+
+def testFutures():
+  (client, server) = socket.socketpair()
+  connection = SwankConnection(client)
+  connection.start()
+  notes = connection.eventQueue("test-notes")
+
+  futures = [TestRpc().symbolAtPoint('a.scala', i)() for i in range(3)]
+
+  # read the 3 calls, answer in reverse order
+  data = ''
+  while data.count("\n") < 3:
+    data += server.recv(4096)
+  callIds = [int(line.split(' ')[-1][:-1]) for line in data.split("\n")[:3]]
+
+  replies = [frame('(:return (:abort 209 "not ready") %d)' % callIds[0])]
+  replies += [frame('(:return (:ok (:name "s%d")) %d)' % (i, callIds[i])) for i in (2, 1)]
+  replies.append(frame('(:test-notes (:notes ()))'))
+  server.sendall(''.join(replies))
+
+  try:
+    futures[0].result(5)
+    print("testFutures: failed - abort expected")
+    return False
+  except SwankAbort as e:
+    if e.code != 209: return False
+
+  if futures[1].result(5).name != "s1" or futures[2].result(5).name != "s2":
+    print("testFutures: failed - wrong responses")
+    return False
+
+  if notes.get(timeout = 5)[0].notes != []:
+    print("testFutures: failed - event")
+    return False
+
+  connection.close()
+  server.close()
+  return True
+
+def testConnectionLost():
+  (client, server) = socket.socketpair()
+  connection = SwankConnection(client)
+  connection.start()
+
+  # the server closes the connection: pending calls are aborted
+  future = TestRpc().symbolAtPoint('a.scala', 1)()
+  server.recv(4096)
+  server.close()
+  try:
+    future.result(5)
+    print("testConnectionLost: failed - abort expected")
+    return False
+  except SwankAbort as e:
+    if e.code != SwankProcessor().ClientAbort: return False
+  connection.close()
+
+  # the calls of a failed write are aborted
+  def send(data):
+    raise socket.error(32, 'Broken pipe')
+  SwankProcessor().setSendFunction(send)
+  futures = [TestRpc().symbolAtPoint('a.scala', i)() for i in range(2)]
+  for f in futures:
+    try:
+      f.result(0)
+      print("testConnectionLost: failed - send error expected")
+      return False
+    except SwankAbort:
+      pass
+
+  if len(SwankProcessor().callHandler) != 0:
+    print("testConnectionLost: failed - calls left: %s" % SwankProcessor().callHandler.keys())
+    return False
+
+  return True
+
+def testTimeoutAndCancel():
+  processor = SwankProcessor()
+  processor.setSendFunction(lambda data: None)
+
+  futures = [TestRpc().symbolAtPoint('a.scala', i)() for i in range(3)]
+  processor.setTimeout(0.01)
+  futures.append(TestRpc().symbolAtPoint('a.scala', 3)())
+  processor.setTimeout(None)
+
+  # cancelled call: late response dropped
+  futures[0].cancel()
+  processor.process(frame('(:return (:ok (:name "late")) %d)' % futures[0].callId))
+  try:
+    futures[0].result(0)
+    return False
+  except SwankCancelled:
+    pass
+
+  # expired call
+  processor.expire(time.time() + 1)
+  try:
+    futures[3].result(0)
+    return False
+  except SwankTimeout:
+    pass
+
+  # too many calls pending: the oldest is dropped
+  processor.setMaxPending(len(processor.callHandler))
+  futures.append(TestRpc().symbolAtPoint('a.scala', 4)())
+  processor.setMaxPending(1000)
+  if not futures[1].done() or futures[2].done():
+    print("testTimeoutAndCancel: failed - oldest call not dropped")
+    return False
+
+  for f in futures[2:]: f.cancel()
+  if len(processor.callHandler) != 0:
+    print("testTimeoutAndCancel: failed - calls left: %s" % processor.callHandler.keys())
+    return False
+
+  # forgotten calls whose response never arrives are dropped after a while:
+  # responses are no longer held back
+  if futures[3].callId not in processor.forgotten:
+    print("testTimeoutAndCancel: failed - expired call not forgotten")
+    return False
+  processor.expire(time.time() + processor.ForgetDelay - 1)
+  if futures[3].callId not in processor.forgotten:
+    print("testTimeoutAndCancel: failed - expired call dropped too early")
+    return False
+  processor.expire(time.time() + processor.ForgetDelay + 2)
+  if processor.hasForgotten():
+    print("testTimeoutAndCancel: failed - forgotten calls left: %s" % processor.forgotten.keys())
+    return False
+
+  return True
+
+@SwankCaller("swank-rpc")
+class TestCompletionRpc:
+  @SwankMethod("swank:completions", supersede = lambda filename, *args: filename)
+  def completions(filename, offset, limit, case): pass
+
+def testSupersede():
+  processor = SwankProcessor()
+  processor.setSendFunction(lambda data: None)
+  builder = processor.messages.parser.builder
+  parsed = []
+  builder.string = lambda raw: parsed.append(raw) or raw
+
+  first = TestCompletionRpc().completions('a.scala', 10, 20, False)()
+  other = TestCompletionRpc().completions('b.scala', 10, 20, False)()
+  last = TestCompletionRpc().completions('a.scala', 11, 20, False)()
+
+  try:
+    first.result(0)
+    print("testSupersede: failed - call not superseded")
+    return False
+  except SwankCancelled:
+    pass
+
+  # the response of the superseded call is dropped before being parsed
+  reply = '(:return (:ok (:completions ((:name "skipped")))) %d)'
+  data = frame(reply % first.callId) + frame(reply.replace('skipped', 'kept') % last.callId)
+  for i in range(0, len(data), 5):
+    processor.process(data[i:i+5])
+  del builder.string
+
+  if 'skipped' in parsed or first.callId in processor.forgotten or last.result(0).completions[0].name != 'kept':
+    print("testSupersede: failed - parsed: %s" % parsed)
+    return False
+
+  if other.done() or not processor.cancel(other.callId):
+    print("testSupersede: failed - other file superseded")
+    return False
+
+  # supersede keys are dropped with the calls holding them
+  if processor.superseding != {}:
+    print("testSupersede: failed - superseding: %s" % processor.superseding)
+    return False
+
+  # once no cancelled call can get a response, responses are parsed as they arrive
+  processor.expire(time.time() + processor.ForgetDelay + 1)
+  future = TestCompletionRpc().completions('a.scala', 12, 20, False)()
+  data = frame(reply.replace('skipped', 'streamed') % future.callId)
+  builder.string = lambda raw: parsed.append(raw) or raw
+  processor.process(data[:-4])
+  streamed = 'streamed' in parsed
+  processor.process(data[-4:])
+  del builder.string
+
+  if not streamed or future.result(0).completions[0].name != 'streamed':
+    print("testSupersede: failed - response not streamed")
+    return False
+
+  return True
+
+def testBatch():
+  writes = []
+  processor = SwankProcessor()
+  processor.setSendFunction(writes.append)
+  responses = []
+
+  class Handler(SwankCallHandler):
+    def response(self, response):
+      responses.append(response)
+
+  batch = SwankBatch()
+  futures = [batch.add(TestRpc().symbolAtPoint('a.scala', i)) for i in range(3)]
+  batch.add(TestRpc().symbolAtPoint('a.scala', 3), Handler())
+  done = batch.send()
+
+  calls = batch.calls
+  if len(writes) != 1 or writes[0] != ''.join(call.asFrame() for call in calls):
+    print("testBatch: failed - writes: %s" % writes)
+    return False
+
+  replies = [frame('(:return (:ok (:name "s%d")) %d)' % (i, calls[i].callId)) for i in (3, 1, 0)]
+  processor.process(''.join(replies))
+  if done.done() or futures[0].result(0).name != "s0" or responses[0].name != "s3":
+    print("testBatch: failed - early barrier")
+    return False
+
+  processor.process(frame('(:return (:abort 209 "not ready") %d)' % calls[2].callId))
+  results = done.result(0)
+  if [r.name for r in results[:2]] != ["s0", "s1"] or results[2].code != 209:
+    print("testBatch: failed - results: %s" % results)
+    return False
+
+  return True
+
+def testEventSubscribers():
+  processor = SwankProcessor()
+  builder = processor.messages.parser.builder
+  parsed = []
+  builder.string = lambda raw: parsed.append(raw) or raw
+  events = []
+
+  first = lambda *args: events.append(('first', args))
+  second = lambda *args: events.append(('second', args))
+  processor.registerEvent(KeywordAtom('test-message'), first)
+  processor.registerEvent(KeywordAtom('test-message'), second)
+
+  # unsubscribed events are not parsed
+  skipped = processor.messages.skipped
+  data = frame('(:test-flood 105 "skipped")') * 3 + frame('(:test-message 105 "kept")')
+  for i in range(0, len(data), 7):
+    processor.process(data[i:i+7])
+  del builder.string
+
+  if parsed != ['kept'] or processor.messages.skipped != skipped + 3:
+    print("testEventSubscribers: failed - parsed: %s" % parsed)
+    return False
+
+  if events != [('first', (105, 'kept')), ('second', (105, 'kept'))]:
+    print("testEventSubscribers: failed - events: %s" % events)
+    return False
+
+  processor.unregisterEvent(KeywordAtom('test-message'), first)
+  processor.unregisterEvent(KeywordAtom('test-message'), second)
+  if not processor.isUnsubscribed(':test-message'):
+    print("testEventSubscribers: failed - still subscribed")
+    return False
+
+  return True
+
+def testStats():
+  processor = SwankProcessor()
+  processor.setSendFunction(lambda data: None)
+  processor.enableStats(60)
+  processor.registerEvent(KeywordAtom('test-stats'), lambda *args: None)
+
+  future = TestRpc().symbolAtPoint('a.scala', 1)()
+  data = frame('(:return (:ok (:name "s")) %d)' % future.callId)
+  data += frame('(:test-stats 1 2)') + frame('(:test-unsubscribed 3)')
+  processor.process(data)
+
+  stats = processor.stats()
+  histograms = stats['histograms']
+  if histograms['rtt swank:symbol-at-point']['count'] != 1 or histograms['frame size']['count'] != 3:
+    print("testStats: failed - histograms: %s" % histograms.keys())
+    return False
+
+  if histograms['frame size']['max'] != len('(:return (:ok (:name "s")) %d)' % future.callId):
+    print("testStats: failed - frame size: %s" % histograms['frame size'])
+    return False
+
+  if stats['counters'] != {'event :test-stats': 1, 'skipped :test-unsubscribed': 1}:
+    print("testStats: failed - counters: %s" % stats['counters'])
+    return False
+
+  processor.expire(time.time() + 60)
+  processor.disableStats()
+  if processor.stats() != None:
+    return False
+
+  return True
+
+def testCallIdsThreads():
+  ids = []
+
+  def makeCalls():
+    ids.extend([SwankCall().callId for i in range(20000)])
+
+  threads = [threading.Thread(target = makeCalls) for i in range(8)]
+  for t in threads: t.start()
+  for t in threads: t.join()
+
+  if len(set(ids)) != len(ids):
+    print("testCallIdsThreads: failed - %d distinct ids out of %d" % (len(set(ids)), len(ids)))
+    return False
+
+  return True
+
+testThemAll = [
+  testBufferMessageChunks,
+  testBufferMessageUtf8,
+  testProcess,
+  testFutures,
+  testConnectionLost,
+  testTimeoutAndCancel,
+  testSupersede,
+  testBatch,
+  testEventSubscribers,
+  testStats,
+  testCallIdsThreads
+]
+
+def main():
+  for testFct in testThemAll:
+    if not testFct():
+      print("Test function failed")
+      return 1
+
+  print("All tests passed")
+  return 0
+
+if __name__ == '__main__':
+  ret = main()
+  sys.exit(ret)
@@ -0,0 +1,54 @@
+# TestSwankStats.py
+#
+# Copyright 2012 Jeanluc Chasseriau <jeanluc@lo.cx>
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+sys.path.append("../../main/python")
+from SwankStats import *
+
+log = logging.getLogger('TestSwankStats')
+
+def testHistogram():
+  h = Histogram()
+  for v in [0.3, 1, 2, 3, 5, 6, 7, 100]:
+    h.add(v)
+
+  d = h.asDict()
+  if d['count'] != 8 or d['min'] != 0.3 or d['max'] != 100 or d['mean'] != 124.3 / 8:
+    print("testHistogram: failed - %s" % d)
+    return False
+
+  if d['p50'] != 4 or d['p90'] != 100 or d['buckets'] != [(0.5, 1), (2, 1), (4, 2), (8, 3), (128, 1)]:
+    print("testHistogram: failed - %s" % d)
+    return False
+
+  return True
+
+testThemAll = [
+  testHistogram
+]
+
+def main():
+  for testFct in testThemAll:
+    if not testFct():
+      print("Test function failed")
+      return 1
+
+  print("All tests passed")
+  return 0
+
+if __name__ == '__main__':
+  ret = main()
+  sys.exit(ret)